@@ -1,15 +1,23 @@
 '''Hub implementing the Direct Connect protocol'''
 
+from bisect import bisect_left
+from collections import deque, OrderedDict
 from ConfigParser import RawConfigParser
+import errno
 import logging
 from logging.handlers import SysLogHandler
+import operator
 import os
-from select import select
+from Queue import Queue, Empty, Full
+import re
+import select
 from sets import Set as set
 import signal
 import socket
 import sys
+import threading
 import time
+import zlib
 
 ''' SSP: '''
 import FBConnectIface
@@ -22,6 +30,41 @@ if os.name == 'posix':
 
 __version__ = '0.2.4'
 myinfoformat = '$MyINFO $ALL %s %s%s$ $%s%s$%s$%i$|'
+# Formats of the messages the hub sends, by message name.  The give* 
+# functions use the copy in hub.nmdcformats, so a subclass can change the
+# format of a message without overriding the function that sends it.
+nmdcformats = {
+    'BadPass': '$BadPass|',
+    'ChatMessage': '<%s> %s|',
+    'ConnectToMe': '$ConnectToMe %s %s:%s|',
+    'EmptyCommand': '|',
+    'EmptyOpList': '$OpList |',
+    'FBAuthError': '<Hub-Security> Access Denied.|$FBAuthError|',
+    'FBLogin': '<Login URL> If not logged in, please login at %s to access this hub.|$FBLogin %s|',
+    'ForceMove': '$ForceMove %s|',
+    'ForceMoveMessage': '$ForceMove %s|$To: %s From: %s $<%s> You are being redirected to %s because: %s|',
+    'GetPass': '$GetPass|',
+    'Hello': '$Hello %s|',
+    'HubIsFull': '$HubIsFull|',
+    'HubName': '$HubName %s|',
+    'HubSecurityMessage': '<Hub-Security> %s|',
+    'LogedIn': '$LogedIn %s|',
+    'Lock': '$Lock %s Pk=%s|',
+    'MeMessage': '* %s%s|',
+    'NickList': '$NickList %s$$|',
+    'OpList': '$OpList %s$$|',
+    'PrivateMessage': '$To: %s From: %s $%s|',
+    'Quit': '$Quit %s|',
+    'RevConnectToMe': '$RevConnectToMe %s %s|',
+    'Search': '$Search %s %s?%s?%s?%s?%s|',
+    'SpamNotification': '<Hub-Security> Your message was dropped because it violates our spam/flood limits.|',
+    'SR': '$SR %s %s\x05%i %i/%i\x05%s (%s)|',
+    'Supports': '$Supports %s|',
+    'UserIP': '$UserIP %s %s|',
+    'UserIPList': '$UserIP %s$$|',
+    'ValidateDenide': '$ValidateDenide|',
+    'WelcomeMessage': '<Hub-Security> This hub is running version %s of py-dchub.\r\n%s|',
+    }
 # Make sure bots can import DCHub under chroot without sys.path trickery
 _mod = __import__('DCHub')
 
@@ -122,6 +165,745 @@ class IntelConfigParser(RawConfigParser):
             fil.seek(startpos)
         return '\n'.join(outputlines)
 
+class SelectPoller(object):
+    '''Readiness notification using select, available on all platforms
+    
+    The registered sockets are kept between calls, so they don't need to be
+    rebuilt on every iteration of the main loop, but select itself still
+    examines every socket on each call and is limited to FD_SETSIZE sockets.
+    '''
+    name = 'select'
+    
+    def __init__(self):
+        self.readers, self.writers = {}, {}
+        
+    def modify(self, fd, write):
+        '''Change whether the socket is checked for writeability'''
+        if write:
+            self.writers[fd] = True
+        elif fd in self.writers:
+            del self.writers[fd]
+        
+    def poll(self, timeout):
+        '''Return lists of readable, writeable, and errored sockets'''
+        readers = self.readers.keys()
+        try:
+            return select.select(readers, self.writers.keys(), readers, timeout)
+        except select.error, error:
+            if error[0] != errno.EINTR:
+                raise
+        return [], [], []
+        
+    def register(self, fd, write=False):
+        '''Start checking the socket for readability (and writeability)'''
+        self.readers[fd] = True
+        self.modify(fd, write)
+        
+    def unregister(self, fd):
+        '''Stop checking the socket'''
+        if fd in self.readers:
+            del self.readers[fd]
+        if fd in self.writers:
+            del self.writers[fd]
+            
+class PollPoller(object):
+    '''Readiness notification using poll
+    
+    Only sockets that are ready are returned, so the cost of each call does
+    not depend on the number of sockets and there is no FD_SETSIZE limit.
+    '''
+    name = 'poll'
+    
+    def __init__(self):
+        self.poller = select.poll()
+        self.readmask = select.POLLIN | select.POLLPRI
+        self.writemask = select.POLLOUT
+        self.hangupmask = select.POLLHUP
+        self.errormask = select.POLLERR | select.POLLNVAL
+        self.timeoutscale = 1000
+        
+    def modify(self, fd, write):
+        '''Change whether the socket is checked for writeability'''
+        self.poller.modify(fd, write and self.readmask | self.writemask or self.readmask)
+        
+    def poll(self, timeout):
+        '''Return lists of readable, writeable, and errored sockets
+        
+        Sockets that have hung up are returned as readable, so that any
+        remaining data is read before the zero length read that removes them.
+        '''
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout * self.timeoutscale
+        try:
+            events = self.poller.poll(timeout)
+        except (select.error, IOError), error:
+            if error.args[0] != errno.EINTR:
+                raise
+            return [], [], []
+        readable, writeable, errored = [], [], []
+        readmask = self.readmask | self.hangupmask
+        for fd, event in events:
+            if event & self.errormask:
+                errored.append(fd)
+                continue
+            if event & readmask:
+                readable.append(fd)
+            if event & self.writemask:
+                writeable.append(fd)
+        return readable, writeable, errored
+        
+    def register(self, fd, write=False):
+        '''Start checking the socket for readability (and writeability)'''
+        self.poller.register(fd, write and self.readmask | self.writemask or self.readmask)
+        
+    def unregister(self, fd):
+        '''Stop checking the socket'''
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError, OSError):
+            pass
+            
+class EpollPoller(PollPoller):
+    '''Readiness notification using epoll (Linux only)
+    
+    Like poll, but the kernel keeps the set of registered sockets, so there
+    is no per call cost for passing the set of sockets to the kernel.
+    '''
+    name = 'epoll'
+    
+    def __init__(self):
+        self.poller = select.epoll()
+        self.readmask = select.EPOLLIN | select.EPOLLPRI
+        self.writemask = select.EPOLLOUT
+        self.hangupmask = select.EPOLLHUP
+        self.errormask = select.EPOLLERR
+        self.timeoutscale = 1
+        
+# Readiness notification backends that can be given as pollertype in the
+# configuration file, in order of preference when pollertype is auto
+pollertypes = ['epoll', 'poll', 'select']
+pollerclasses = {'epoll':EpollPoller, 'poll':PollPoller, 'select':SelectPoller}
+# Socket errors meaning that a non-blocking call would have blocked or was
+# interrupted, and should just be tried again when the socket is ready
+blockingerrors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Response to requests to the metrics listener, and the names of histograms
+# of command stages, give functions, and queue delays
+httpresponseformat = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %i\r\nConnection: close\r\n\r\n%s'
+prometheusnameregexp = re.compile(r'^(parse|check|got|give|queuedelay)(.+)$')
+
+# Compiled regular expressions that find any of a set of characters, by the
+# string of characters
+charpatterns = {}
+
+def charsearcher(chars):
+    '''Return a function finding the first of chars in a string
+    
+    The function is the search method of a compiled regular expression, so
+    the string is scanned once in C, and it returns a match object or None.
+    The compiled expressions are cached, so this is cheap to call with the
+    same characters (such as the hub's badchars) over and over.
+    '''
+    search = charpatterns.get(chars)
+    if search is None:
+        if len(charpatterns) > 100:
+            charpatterns.clear()
+        if chars:
+            pattern = '[%s]' % ''.join(['\\x%02x' % ord(char) for char in chars])
+        else:
+            # Never matches
+            pattern = '(?!)'
+        search = charpatterns[chars] = re.compile(pattern).search
+    return search
+
+class IncomingBuffer(object):
+    '''Splits data received from a socket into commands
+    
+    Data is read with recv_into into a buffer that is reused for every read.
+    Only the newly received data is searched for the '|' delimiter, and
+    completed commands are placed in the commands deque, so taking the next
+    command off the queue is O(1).  The time each command was received is
+    kept in arrivals, in the same order as commands.  The incomplete command
+    at the end of the data is kept in partial until the rest of it arrives.
+    
+    partial is never allowed to grow beyond maxcommandsize + 1 bytes.  A
+    longer command is truncated, so it is still rejected by badcommand
+    without the whole command being buffered.
+    '''
+    def __init__(self, buffersize=1024):
+        self.commands = deque()
+        self.arrivals = deque()
+        self.partial = bytearray()
+        self.setbuffersize(buffersize)
+        
+    def __len__(self):
+        return len(self.commands)
+        
+    def discard(self, count):
+        '''Drop the count most recently received commands'''
+        for i in xrange(count):
+            self.commands.pop()
+            self.arrivals.pop()
+        
+    def popleft(self):
+        '''Remove and return the oldest command and the time it was received'''
+        return self.commands.popleft(), self.arrivals.popleft()
+        
+    def received(self, size):
+        '''Return the data received by the last recv'''
+        return self.readview[:size].tobytes()
+        
+    def recv(self, sock, maxcommandsize, curtime=0):
+        '''Read data from the socket and queue any completed commands
+        
+        curtime is recorded as the time the completed commands were received.
+        Returns the number of bytes read, which is 0 if the connection was
+        closed.  Socket errors are not caught.
+        '''
+        size = sock.recv_into(self.readbuffer)
+        find, readview, partial = self.readbuffer.find, self.readview, self.partial
+        queued = len(self.commands)
+        start = 0
+        end = find('|', 0, size)
+        while end != -1:
+            if partial:
+                partial += readview[start:end]
+                self.commands.append(str(partial[:maxcommandsize + 1]))
+                del partial[:]
+            else:
+                self.commands.append(readview[start:end].tobytes())
+            start = end + 1
+            end = find('|', start, size)
+        if start < size and len(partial) <= maxcommandsize:
+            partial += readview[start:size]
+            if len(partial) > maxcommandsize + 1:
+                del partial[maxcommandsize + 1:]
+        if len(self.commands) > queued:
+            self.arrivals.extend([curtime] * (len(self.commands) - queued))
+        return size
+        
+    def setbuffersize(self, buffersize):
+        '''Change the maximum amount of data read from the socket at once'''
+        self.readbuffer = bytearray(buffersize)
+        self.readview = memoryview(self.readbuffer)
+        
+class OutgoingBuffer(object):
+    '''Queue of data waiting to be sent to a socket
+    
+    Messages are kept as a queue of separate chunks instead of being
+    concatenated, and partial sends only move the offset into the first
+    chunk, so neither queueing nor sending copies the rest of the buffered
+    data.  Small chunks at the front of the queue are coalesced before
+    sending, so that bursts of short messages go out in a few large sends.
+    
+    size (also available via len) is the number of bytes left to send, and
+    prepared the number of bytes at the front of the queue that have already
+    been compressed (or found not worth compressing) by compress.
+    '''
+    def __init__(self, coalescesize=65536):
+        self.chunks = deque()
+        self.offset = 0
+        self.size = 0
+        self.prepared = 0
+        self.coalescesize = coalescesize
+        
+    def __len__(self):
+        return self.size
+        
+    def append(self, data):
+        '''Add data to the end of the queue'''
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+            
+    def extend(self, chunks):
+        '''Add each of the chunks to the end of the queue'''
+        for data in chunks:
+            if data:
+                self.chunks.append(data)
+                self.size += len(data)
+            
+    def clear(self):
+        '''Discard all queued data'''
+        self.chunks.clear()
+        self.offset = 0
+        self.size = 0
+        self.prepared = 0
+        
+    def compress(self, level, threshold, slicesize):
+        '''Compress messages at the front of the queue into a ZPipe block
+        
+        Nothing is done unless at least threshold bytes are queued and the
+        front of the queue hasn't been partially sent or already prepared.
+        At most slicesize bytes are compressed at a time, cut after the last
+        complete message, so a large queue is compressed a slice at a time as
+        it is sent.  Return the sizes of the data before and after
+        compressing, or None if nothing was compressed.
+        '''
+        if self.size < threshold or self.offset or self.prepared:
+            return None
+        chunks = self.chunks
+        parts = [chunks.popleft()]
+        total = len(parts[0])
+        while chunks and total + len(chunks[0]) <= slicesize:
+            parts.append(chunks.popleft())
+            total += len(parts[-1])
+        data = ''.join(parts)
+        if total > slicesize:
+            end = data.rfind('|', 0, slicesize) + 1
+            if end:
+                chunks.appendleft(data[end:])
+                data = data[:end]
+        if len(data) >= threshold:
+            block = '$ZOn|%s' % zlib.compress(data, level)
+            if len(block) < len(data):
+                chunks.appendleft(block)
+                self.size -= len(data) - len(block)
+                self.prepared = len(block)
+                return len(data), len(block)
+        # Not worth compressing, so send it as it is
+        chunks.appendleft(data)
+        self.prepared = len(data)
+        return None
+        
+    def consume(self, size):
+        '''Remove size bytes from the front of the queue (after sending them)'''
+        self.size -= size
+        self.prepared = max(self.prepared - size, 0)
+        offset = self.offset + size
+        chunks = self.chunks
+        while chunks and offset >= len(chunks[0]):
+            offset -= len(chunks.popleft())
+        self.offset = offset
+        
+    def nextchunk(self):
+        '''Return the data at the front of the queue, to be given to send
+        
+        If the first chunk has been partially sent, a buffer pointing into it
+        is returned instead of a copy of the unsent part.  Chunks prepared by
+        compress are sent on their own, so the data after them can still be
+        compressed.
+        '''
+        chunks = self.chunks
+        first = chunks[0]
+        if len(chunks) > 1 and not self.prepared and len(first) - self.offset < self.coalescesize:
+            parts = [first[self.offset:]]
+            total = len(parts[0])
+            chunks.popleft()
+            while chunks and total + len(chunks[0]) <= self.coalescesize:
+                parts.append(chunks.popleft())
+                total += len(parts[-1])
+            first = ''.join(parts)
+            chunks.appendleft(first)
+            self.offset = 0
+        if self.offset:
+            return buffer(first, self.offset)
+        return first
+
+class ExpiringIndex(object):
+    '''Set of keys that each expire some time after they were added
+    
+    keys maps each key to the time it was added, for constant time lookups,
+    and events holds (time, key) tuples in the order they were added, so
+    expiring keys only looks at the keys that are expiring.
+    '''
+    def __init__(self):
+        self.events = deque()
+        self.keys = {}
+        
+    def __contains__(self, key):
+        return key in self.keys
+        
+    def __len__(self):
+        return len(self.keys)
+        
+    def add(self, key, eventtime):
+        '''Add key to the index at eventtime (which must not be before the
+        time of any key already in the index)'''
+        self.keys[key] = eventtime
+        self.events.append((eventtime, key))
+        
+    def expire(self, cutoff):
+        '''Remove the keys that were added at or before cutoff'''
+        events, keys = self.events, self.keys
+        while events and events[0][0] <= cutoff:
+            eventtime, key = events.popleft()
+            # Keys added again since are still in events at their new time
+            if keys.get(key) == eventtime:
+                del keys[key]
+
+class Histogram(object):
+    '''Distribution of durations, for percentiles of latencies
+    
+    Durations are counted in buckets whose upper bounds (in seconds) grow by
+    a factor of 2**0.25 from 1 microsecond to about 134 seconds, with a last
+    bucket for anything longer, so adding a duration is a binary search and
+    percentiles are estimated to within 19%.
+    '''
+    bounds = [0.000001 * 2 ** (i / 4.0) for i in range(109)]
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count, self.total, self.max = 0, 0.0, 0.0
+        
+    def add(self, duration):
+        '''Add a duration to the distribution'''
+        self.counts[bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+            
+    def percentile(self, percent):
+        '''Return the upper bound of the bucket containing the percentile'''
+        return self.percentiles([percent])[0]
+        
+    def percentiles(self, percents):
+        '''Return the percentile for each of the (ascending) percents'''
+        results, seen = [], 0
+        targets = [self.count * percent / 100.0 for percent in percents]
+        for i, count in enumerate(self.counts):
+            seen += count
+            while count and len(results) < len(targets) and seen >= targets[len(results)]:
+                results.append(min(self.bounds[i:i+1] + [self.max]))
+        return results + [0.0] * (len(targets) - len(results))
+
+class MyINFOSnapshot(object):
+    '''MyINFO of every logged in user, for giving to users that log in
+    
+    Users are kept in slots, grouped into segments of segmentsize slots, and
+    each segment's (user, MyINFO) pairs and joined MyINFOs are cached until 
+    a user in the segment changes.  Giving a new user everyone's MyINFO then
+    only needs the cached strings, and a user joining or changing their
+    MyINFO only invalidates a single segment.  Users leaving leave a hole in
+    their slot, and the slots are compacted once more than half are holes.
+    '''
+    def __init__(self, segmentsize=64):
+        self.segmentsize = segmentsize
+        self.slots = []
+        self.positions = {}
+        self.cache = {}
+        self.holes = 0
+        
+    def __len__(self):
+        return len(self.positions)
+        
+    def add(self, user):
+        '''Add the user's current MyINFO, replacing any earlier one'''
+        position = self.positions.get(user.nick)
+        if position is None:
+            position = self.positions[user.nick] = len(self.slots)
+            self.slots.append(None)
+        self.slots[position] = (user, user.myinfo)
+        self.cache.pop(position // self.segmentsize, None)
+        
+    def compact(self):
+        '''Remove the holes left by users that have been removed'''
+        self.slots = [slot for slot in self.slots if slot is not None]
+        self.positions = dict([(slot[0].nick, i) for i, slot in enumerate(self.slots)])
+        self.cache.clear()
+        self.holes = 0
+        
+    def remove(self, user):
+        '''Remove the user, if they are in the snapshot'''
+        position = self.positions.get(user.nick)
+        if position is None or self.slots[position][0] is not user:
+            return
+        del self.positions[user.nick]
+        self.slots[position] = None
+        self.holes += 1
+        self.cache.pop(position // self.segmentsize, None)
+        if self.holes > self.segmentsize and self.holes * 2 > len(self.slots):
+            self.compact()
+            
+    def segments(self):
+        '''Return the (user, MyINFO) pairs and the joined MyINFOs of each 
+        segment'''
+        segments, cache, size = [], self.cache, self.segmentsize
+        for start in xrange(0, len(self.slots), size):
+            segment = cache.get(start // size)
+            if segment is None:
+                entries = [slot for slot in self.slots[start:start + size] if slot is not None]
+                segment = cache[start // size] = (entries, ''.join([myinfo for user, myinfo in entries]))
+            segments.append(segment)
+        return segments
+
+class SlidingWindow(object):
+    '''Recent events, with running totals, for rate limiting
+    
+    Events are tuples of the time of the event followed by any values, and
+    are added in time order, so old events are always removed from the left
+    side of the deque.  totals holds the sums of the first numtotals values
+    of the events in the window, updated as events are added and removed,
+    so checking a limit never has to look at every event.
+    '''
+    def __init__(self, numtotals=0):
+        self.events = deque()
+        self.totals = [0] * numtotals
+        
+    def __len__(self):
+        return len(self.events)
+        
+    def add(self, *event):
+        '''Add an event (a time followed by its values) to the window'''
+        self.events.append(event)
+        totals = self.totals
+        for i in xrange(len(totals)):
+            totals[i] += event[i + 1]
+            
+    def expire(self, cutoff):
+        '''Remove the events that happened at or before cutoff'''
+        events, totals = self.events, self.totals
+        while events and events[0][0] <= cutoff:
+            event = events.popleft()
+            for i in xrange(len(totals)):
+                totals[i] -= event[i + 1]
+                
+    def oldest(self):
+        '''Return the time of the oldest event in the window'''
+        return self.events[0][0]
+
+class TimerWheel(object):
+    '''Hashed timing wheel for scheduling work at a later time
+
+    Time is divided into ticks of resolution seconds, and each timer is
+    stored in the slot for the tick it is due in (modulo the number of
+    slots), so scheduling, cancelling, and finding the timers that are due
+    don't depend on the number of timers.  Timers due more than one turn of
+    the wheel in the future just stay in their slot until they are due.
+
+    Each timer has a unique key (scheduling a key again replaces the old
+    timer), and stores the name of a function to call with some arguments,
+    instead of the function itself, so that timers keep working when the hub
+    is reloaded.
+    '''
+    def __init__(self, resolution=0.1, numslots=1024, curtime=None):
+        if curtime is None:
+            curtime = time.time()
+        self.resolution = resolution
+        self.numslots = numslots
+        self.slots = [{} for i in xrange(numslots)]
+        # Mapping of keys to the tick the timer is in
+        self.timers = {}
+        # Last tick that has been expired
+        self.tick = int(curtime / resolution)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def cancel(self, key):
+        '''Remove the timer for key, if there is one'''
+        tick = self.timers.pop(key, None)
+        if tick is not None:
+            del self.slots[tick % self.numslots][key]
+
+    def expire(self, curtime):
+        '''Remove and return all timers that are due
+
+        Returns a list of (deadline, functionname, args) tuples, sorted by
+        deadline.
+        '''
+        target = int(curtime / self.resolution)
+        start = max(self.tick + 1, target - self.numslots + 1)
+        due = []
+        slots, numslots, timers = self.slots, self.numslots, self.timers
+        for tick in xrange(start, target + 1):
+            slot = slots[tick % numslots]
+            if slot:
+                for key, timer in slot.items():
+                    if timer[0] <= curtime:
+                        del slot[key]
+                        del timers[key]
+                        due.append(timer)
+        self.tick = max(self.tick, target)
+        due.sort()
+        return due
+
+    def nexttimeout(self, curtime, maxtimeout):
+        '''Return the number of seconds until the next timer may be due
+
+        The result is never more than maxtimeout, and only the slots within
+        maxtimeout are checked.  Timers in those slots that are due on a later
+        turn of the wheel are skipped.
+        '''
+        if not self.timers:
+            return maxtimeout
+        resolution, numslots, slots, timers = self.resolution, self.numslots, self.slots, self.timers
+        lasttick = min(int((curtime + maxtimeout) / resolution), self.tick + numslots)
+        for tick in xrange(self.tick + 1, lasttick + 1):
+            slot = slots[tick % numslots]
+            if slot:
+                for key in slot:
+                    if timers[key] == tick:
+                        return min(max(tick * resolution - curtime, 0), maxtimeout)
+        return maxtimeout
+
+    def schedule(self, key, deadline, functionname, *args):
+        '''Call the function named functionname with args at deadline
+
+        The timer is put in the slot for the first tick starting at or after
+        deadline, so it is due by the time that tick is expired.
+        '''
+        self.cancel(key)
+        tick = int(deadline / self.resolution)
+        if tick * self.resolution < deadline:
+            tick += 1
+        tick = max(tick, self.tick + 1)
+        self.slots[tick % self.numslots][key] = (deadline, functionname, args)
+        self.timers[key] = tick
+
+class QueueLogHandler(logging.Handler):
+    '''Logging handler that queues records to be handled later
+    
+    Queueing a record only merges its arguments and exception into its
+    message, so that it can be formatted later.  At most maxsize records are
+    queued (0 for no limit).  Records that don't fit are dropped, and once
+    there is room again, a single warning with the number of records dropped
+    is queued in their place.  Consumers take records from the queue with
+    getrecords.
+    '''
+    def __init__(self, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+        
+    def emit(self, record):
+        '''Queue the record, or drop it if the queue is full'''
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.LogRecord(record.name, logging.WARNING, __file__, 0, 
+                  '%i log messages dropped because the log queue was full', (self.dropped,), None))
+                self.dropped = 0
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+            
+    def getrecords(self, maxrecords=0, block=False):
+        '''Return up to maxrecords queued records (0 for all of them)
+        
+        If block is True, wait until there is at least one record.
+        '''
+        records = []
+        try:
+            if block:
+                records.append(self.queue.get())
+            while not maxrecords or len(records) < maxrecords:
+                records.append(self.queue.get_nowait())
+        except Empty:
+            pass
+        return records
+        
+    def prepare(self, record):
+        '''Merge the record's arguments and exception into its message'''
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class BackgroundLogHandler(QueueLogHandler):
+    '''Logging handler that passes records to other handlers in a thread
+    
+    The main loop only has to queue records, and a writer thread does the
+    blocking disk and network I/O for handlers, in batches of at most 
+    batchsize records.  Stream handlers (including file handlers) write each
+    batch with a single write and flush.  The writer is started when the 
+    first record is queued (or if it has stopped, such as after forking).
+    '''
+    def __init__(self, handlers, maxsize=10000, batchsize=100):
+        QueueLogHandler.__init__(self, maxsize)
+        self.handlers = handlers
+        self.batchsize = batchsize
+        self.writer = None
+        
+    def close(self):
+        '''Stop the writer once the queued records are written'''
+        if self.writer is not None and self.writer.isAlive():
+            self.queue.put(None)
+            self.writer.join()
+        else:
+            self.writequeued()
+        for handler in self.handlers:
+            handler.close()
+        QueueLogHandler.close(self)
+        
+    def emit(self, record):
+        '''Queue the record for the writer thread'''
+        if self.writer is None or not self.writer.isAlive():
+            self.writer = threading.Thread(target=self.run)
+            self.writer.setDaemon(1)
+            self.writer.start()
+        QueueLogHandler.emit(self, record)
+            
+    def flush(self):
+        '''Wait until the queued records have been written'''
+        if self.writer is not None and self.writer.isAlive():
+            self.queue.join()
+        else:
+            self.writequeued()
+            
+    def run(self):
+        '''Write batches of records until a None record is queued'''
+        while True:
+            records = self.getrecords(self.batchsize, block=True)
+            self.write([record for record in records if record is not None])
+            for record in records:
+                self.queue.task_done()
+            if None in records:
+                return
+        
+    def write(self, records):
+        '''Pass records to each handler'''
+        for handler in self.handlers:
+            handled = [record for record in records if record.levelno >= handler.level]
+            if not handled:
+                continue
+            if not isinstance(handler, logging.StreamHandler):
+                for record in handled:
+                    handler.handle(record)
+                continue
+            lines = []
+            for record in handled:
+                try:
+                    if handler.filter(record):
+                        lines.append('%s\n' % handler.format(record))
+                except:
+                    handler.handleError(record)
+            handler.acquire()
+            try:
+                try:
+                    handler.stream.write(''.join(lines))
+                    handler.flush()
+                except:
+                    handler.handleError(handled[-1])
+            finally:
+                handler.release()
+                
+    def writequeued(self):
+        '''Write the queued records in this thread, when there is no writer
+        
+        Each record is marked done like the writer does, so a later join of
+        the queue doesn't wait for them.
+        '''
+        records = self.getrecords()
+        self.write([record for record in records if record is not None])
+        for record in records:
+            self.queue.task_done()
+
+class MetricsConnection(object):
+    '''HTTP connection to the hub's metrics listener'''
+    def __init__(self, (sock, (ip, port))):
+        self.socket = sock
+        self.socketid = sock.fileno()
+        self.idstring = '%s:%s/metrics' % (ip, port)
+        self.request = ''
+        self.answered = False
+        self.outgoing = OutgoingBuffer()
+
 class DCHubUser(object):
     '''Any user of a DC Hub (client or bot)'''
     
@@ -147,8 +929,25 @@ class DCHubUser(object):
     def close(self):
         pass
         
+    def endbatch(self, curtime):
+        '''Send the messages collected since startbatch'''
+        pass
+        
+    def sendframe(self, frame, curtime):
+        '''Place a message shared with other users in the outgoing buffer'''
+        self.sendmessage(frame)
+        
+    def sendframes(self, frames, curtime):
+        '''Place several messages in the outgoing buffer at once'''
+        for frame in frames:
+            self.sendframe(frame, curtime)
+        
     def sendmessage(self, message):
         pass
+        
+    def startbatch(self):
+        '''Collect the messages sent to the user until endbatch is called'''
+        pass
 
 class DCHubClient(DCHubUser):
     '''Client connecting to the hub'''
@@ -166,23 +965,98 @@ class DCHubClient(DCHubUser):
         self.idstring = '%s:%s/' % (self.ip, self.port)
         self.myinfo = myinfoformat % (self.nick, self.description, self.tag, self.speed, chr(self.speedclass), self.email, self.sharesize)
         self.validcommands = set('Key Supports ValidateNick'.split())
-        # Necessary for spam/flood prevention
-        self.recentmessages, self.searchtimes, self.myinfotimes = [], [], []
-        self.commandtimes = []
+        # Necessary for spam/flood prevention.  recentmessages has running
+        # totals of message sizes and newlines, and commandtimes of the 
+        # number of commands received.
+        self.recentmessages = SlidingWindow(2)
+        self.searchtimes, self.myinfotimes = SlidingWindow(), SlidingWindow()
+        self.commandtimes = SlidingWindow(1)
+        # Running total of the cost of the commands processed for the user,
+        # for the maxcostpertimeperiod limit
+        self.costs = SlidingWindow(1)
         # Incoming and outgoing buffers for client
-        self.incoming = ['']
-        self.outgoing = ''
+        self.incoming = IncomingBuffer()
+        self.outgoing = OutgoingBuffer()
+        # Readiness notification backend the socket is registered with, set
+        # by the hub when the user is added
+        self.poller = None
         
     def close(self):
         '''Close related socket connection'''
         self.socket.close()
         
+    def endbatch(self, curtime):
+        '''Queue the messages collected since startbatch at once'''
+        batch, self.batch = self.batch, None
+        if batch and not self.ignoremessages:
+            if not self.outgoing.size and self.poller is not None:
+                self.poller.modify(self.socketid, True)
+            self.outgoing.extend(batch)
+            self.lastcommandtime = curtime
+        
+    def getignoremessages(self):
+        return self._ignoremessages
+        
+    def setignoremessages(self, ignoremessages):
+        '''Add the user to the hub's closing users if ignoring messages
+        
+        The closing users are removed by the hub as soon as their outgoing
+        buffer is empty.
+        '''
+        self._ignoremessages = ignoremessages
+        if ignoremessages and self.poller is not None:
+            self.closing[self.socketid] = self
+            
+    ignoremessages = property(getignoremessages, setignoremessages)
+    # Closing users of the hub, and the hub's log and trace levels, set by the
+    # hub when the user is added
+    closing = None
+    log = None
+    tracelevels = {}
+    # Messages collected between startbatch and endbatch
+    batch = None
+        
+    def sendframe(self, frame, curtime):
+        '''Place a message shared with other users in the outgoing buffer
+        
+        The frame is queued by reference, so a message broadcast to the whole
+        hub is only stored once no matter how many users it is sent to.  If
+        the buffer was empty, tell the poller to start checking whether the
+        socket is writeable.
+        '''
+        if self.tracelevels.get('messagetrace'):
+            self.log.log(self.tracelevels['messagetrace'], 'Message to %s: %r' % (self.idstring, frame))
+        if self.batch is not None:
+            return self.batch.append(frame)
+        if not self.ignoremessages:
+            if not self.outgoing.size and self.poller is not None:
+                self.poller.modify(self.socketid, True)
+            self.outgoing.append(frame)
+            self.lastcommandtime = curtime
+            
+    def sendframes(self, frames, curtime):
+        '''Place several messages in the outgoing buffer at once
+        
+        The messages are queued by reference as separate chunks, without
+        being concatenated first.
+        '''
+        if self.tracelevels.get('messagetrace'):
+            self.log.log(self.tracelevels['messagetrace'], 'Messages to %s: %r' % (self.idstring, ''.join(frames)))
+        if self.batch is not None:
+            return self.batch.extend(frames)
+        if not self.ignoremessages:
+            if not self.outgoing.size and self.poller is not None:
+                self.poller.modify(self.socketid, True)
+            self.outgoing.extend(frames)
+            self.lastcommandtime = curtime
+        
     def sendmessage(self, message):
         '''Place a message in the outgoing message buffer for the user'''
-        print message
-        if not self.ignoremessages:
-            self.outgoing += message
-            self.lastcommandtime = time.time()
+        self.sendframe(message, time.time())
+        
+    def startbatch(self):
+        '''Collect the messages sent to the user until endbatch is called'''
+        self.batch = []
         
 class DCHubBot(DCHubUser):
     '''Bot that runs in the same process as the hub
@@ -279,6 +1153,19 @@ class DCHub(object):
         self._copydocstring(function, new_function)
         return new_function
         
+    def _histogramwrapper(self, function, histogram):
+        '''Decorator for functions that adds the time the function takes to 
+        histogram'''
+        tim = time.time
+        def new_function(*args, **kwargs):
+            start = tim()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.add(tim() - start)
+        self._copydocstring(function, new_function)
+        return new_function
+        
     def _timerwrapper(self, function, loglevel, warningtime, warninglevel=logging.WARNING):
         '''Decorator for functions that logs the amount of time the function takes
         
@@ -312,13 +1199,21 @@ class DCHub(object):
         self.hubfullcheck(user)
         '''SSP:'''
         #self.joinfloodcheck(user, 'ip')
-        # Python's select seems broken, even if it returns that a given socket
-        # is writeable, it can block on writing to it, so you need to add a 
-        # timeout or the hub may occassionally freeze for minutes at a time
-        user.socket.settimeout(0.01)
+        # The socket must never block, as a single slow peer would stall the
+        # whole hub.  If a send or recv would block, the data just stays 
+        # queued until the poller says the socket is ready again.
+        user.socket.setblocking(0)
         self.log.log(self.loglevels['newconnection'], "New user connection from %s" % user.idstring)
         self.setuplimits(user)
+        user.incoming.setbuffersize(self.buffersize)
         self.sockets[user.socketid] = user
+        user.closing = self.closing
+        user.log, user.tracelevels = self.log, self.tracelevels
+        user.poller = self.poller
+        self.poller.register(user.socketid, bool(user.outgoing))
+        self.timers.schedule(('keepalive', user), user.lastcommandtime + user.limits['pingtime'], 'keepalive', user)
+        if self.logintimeout:
+            self.timers.schedule(('login', user), time.time() + self.logintimeout, 'expirelogin', user)
         '''SSP: '''
         self.giveFBLoginURL(user)
         
@@ -335,29 +1230,65 @@ class DCHub(object):
             return False
         badchars = self.badchars
         if command.startswith('$MyINFO $ALL '):
-            badcharindex = -1
-            for char in command:
-                if char in badchars:
-                    # MyINFO has one byte that contains ASCII character
-                    # 1-12, so ignore one bad character.
-                    # checkMyINFO should take care of checking for bad 
-                    # characters after the MyINFO has been parsed
-                    if badcharindex != -1:
-                        return True
-                    else:
-                        badcharindex = command.index(char)
-            return False
+            # MyINFO has one byte that contains ASCII character 1-12, so 
+            # ignore one bad character.  checkMyINFO should take care of 
+            # checking for bad characters after the MyINFO has been parsed
+            search = charsearcher(badchars)
+            match = search(command)
+            return match is not None and search(command, match.end()) is not None
         if command.startswith('$SR '):
             # SR uses ASCII chracter 5 as a separator
             badchars = self.badsrchars
-        if self.stringoverlaps(command, badchars):
-            return True
-        return False
+        return charsearcher(badchars)(command) is not None
                
     def badprivileges(self, user, functionname, args):
         '''Check to see if the user has the privileges to execute the command'''
         return functionname not in user.validcommands
         
+    def broadcast(self, message, users=None):
+        '''Give the same message to many users (all logged in users by default)
+        
+        The message is only formatted once, and the same string is queued for
+        every user via sendframe, instead of each user getting a copy.
+        '''
+        if users is None:
+            users = self.users.itervalues()
+        curtime = time.time()
+        for user in users:
+            user.sendframe(message, curtime)
+        
+    def chargecost(self, user, function, command):
+        '''Charge the cost of command to user, if the budgets allow it
+        
+        The cost comes from self.commandcosts, plus extra for the number of
+        users receiving broadcast commands and for the size of the command.
+        Returns False without charging anything if the command would put
+        the user over maxcostpertimeperiod, or the hub over 
+        maxhubcostpersecond while the hub is saturated.
+        '''
+        cost = self.commandcosts.get(function, 1)
+        broadcast = function in self.broadcastcommands
+        if broadcast and self.costperusers:
+            cost += len(self.users) // self.costperusers
+        if self.costperbytes:
+            cost += len(command) // self.costperbytes
+        if not cost:
+            return True
+        curtime = time.time()
+        costs = user.costs
+        costs.expire(curtime - user.limits['timeperiod'])
+        maxcost = user.limits['maxcostpertimeperiod']
+        if maxcost and costs.totals[0] + cost > maxcost:
+            return False
+        if broadcast and self.maxhubcostpersecond:
+            hubcosts = self.hubcosts
+            hubcosts.expire(curtime - 1)
+            if self.saturated and hubcosts.totals[0] + cost > self.maxhubcostpersecond:
+                return False
+            hubcosts.add(curtime, cost)
+        costs.add(curtime, cost)
+        return True
+        
     def cleanup(self):
         '''Close sockets and remove temporary files'''
         if not self.reloadonexit:
@@ -365,20 +1296,45 @@ class DCHub(object):
                 sock.close()
             for user in self.sockets.values():
                 self.removeuser(user)
+            for connection in self.metricsconnections.values():
+                self.closemetricsconnection(connection)
+            if self.metricslistensock is not None:
+                self.metricslistensock.close()
             if os.name == 'posix' and os.path.isfile(self.pidfile):
                 try: 
                     os.remove(self.pidfile)
                 except: 
                     self.log.exception('Error removing pid file')
         self.unloadbots()
+        if self.backgroundloghandler is not None:
+            self.backgroundloghandler.flush()
 
+    def closemetricsconnection(self, connection):
+        '''Close a connection to the metrics listener'''
+        self.poller.unregister(connection.socketid)
+        del self.metricsconnections[connection.socketid]
+        self.timers.cancel(('metrics', connection))
+        connection.socket.close()
+        
     def createlisteningsocket(self, ip, port):
         '''Create an individual listening socket'''
         listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         listensock.bind((ip, port))
-        listensock.listen(1)
+        listensock.listen(self.listenbacklog)
+        listensock.setblocking(0)
         self.listensocks[listensock.fileno()] = listensock
+        self.poller.register(listensock.fileno())
+
+    def createmetricssocket(self):
+        '''Create the listening socket for the metrics listener'''
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listensock.bind((self.metricsip, self.metricsport))
+        listensock.listen(5)
+        listensock.setblocking(0)
+        self.metricslistensock = listensock
+        self.poller.register(listensock.fileno())
 
     def debugexception(self, logmessage, loglevel=logging.DEBUG):
         '''Log an exception if being debugged, log a debug message otherwise'''
@@ -400,6 +1356,12 @@ class DCHub(object):
             self.log.critical("Can't change group or user ids, exiting")
             self.stop = True
             
+    def expirelogin(self, user):
+        '''Disconnect user if they haven't logged in within logintimeout seconds'''
+        if not user.loggedin and self.sockets.get(user.socketid) is user:
+            self.log.log(self.loglevels['userloginerror'], 'User did not log in within %s seconds: %s' % (self.logintimeout, user.idstring))
+            self.removeuser(user)
+            
     def getcommandtype(self, command):
         '''Return type of command and argument string'''
         if command[0] != '$':
@@ -417,6 +1379,175 @@ class DCHub(object):
             return '_PrivateMessage', args
         return functionname, args
         
+    def formatNickList(self):
+        '''Return the NickList message for all users'''
+        return self.nmdcformats['NickList'] % '$$'.join(self.users.keys())
+        
+    def formatOpList(self):
+        '''Return the OpList message for all ops'''
+        if self.ops:
+            return self.nmdcformats['OpList'] % '$$'.join(self.ops.keys())
+        return self.nmdcformats['EmptyOpList']
+        
+    def formatUserIPList(self):
+        '''Return the UserIP message with the IPs of all users'''
+        return self.nmdcformats['UserIPList'] % '$$'.join(['%s %s' % (user.nick, user.ip) for user in self.users.itervalues()])
+        
+    def formatprometheus(self):
+        '''Return the hub's metrics in the Prometheus text format
+        
+        Histograms are given as summaries, with the 50th, 95th, and 99th
+        percentiles, since the exact buckets of every histogram would make
+        scrapes much larger and slower to produce.
+        '''
+        values, histograms = self.getmetrics()
+        families = {}
+        for name, value in values.iteritems():
+            if name.startswith('rejected'):
+                families.setdefault(('dchub_rejected_commands_total', 'counter'), []).append(('{reason="%s"}' % name[8:], value))
+            elif name in self.counters:
+                families[('dchub_%s_total' % name, 'counter')] = [('', value)]
+            else:
+                families[('dchub_%s' % name, 'gauge')] = [('', value)]
+        for name, histogram in histograms.iteritems():
+            match = prometheusnameregexp.match(name)
+            if match is None:
+                family, labels = 'dchub_%s_seconds' % name, ''
+            elif match.group(1) == 'queuedelay':
+                family, labels = 'dchub_queue_delay_seconds', 'command="%s"' % match.group(2)
+                families.setdefault(('dchub_commands_total', 'counter'), []).append(('{%s}' % labels, histogram.count))
+            elif match.group(1) == 'give':
+                family, labels = 'dchub_give_seconds', 'function="%s"' % name
+            else:
+                family, labels = 'dchub_command_seconds', 'stage="%s",command="%s"' % match.groups()
+            samples = families.setdefault((family, 'summary'), [])
+            separator = labels and ',' or ''
+            for quantile, value in zip(('0.5', '0.95', '0.99'), histogram.percentiles([50, 95, 99])):
+                samples.append(('{%s%squantile="%s"}' % (labels, separator, quantile), value))
+            labels = labels and '{%s}' % labels
+            samples.append(('_sum%s' % labels, histogram.total))
+            samples.append(('_count%s' % labels, histogram.count))
+        lines = []
+        for (family, type), samples in sorted(families.items()):
+            lines.append('# TYPE %s %s' % (family, type))
+            for suffix, value in samples:
+                lines.append('%s%s %r' % (family, suffix, value))
+        return '\n'.join(lines) + '\n'
+        
+    def getcommandfunctions(self, functionname):
+        '''Return the parse, check, got, and bad functions for a command type
+        
+        The functions are looked up once and cached in self.commandfunctions,
+        which is cleared whenever hub functions are wrapped, replaced, or
+        restored.  Code that replaces hub functions directly with setattr
+        should clear it as well.
+        '''
+        functions = self.commandfunctions.get(functionname)
+        if functions is None:
+            functions = tuple([getattr(self, '%s%s' % (prefix, functionname)) 
+                for prefix in ('parse', 'check', 'got', 'bad')])
+            self.commandfunctions[functionname] = functions
+        return functions
+        
+    def getcommandhistograms(self, functionname):
+        '''Return the histograms of the time taken by the parse, check, and got
+        functions for a command type, cached in self.commandhistograms'''
+        histograms = self.commandhistograms.get(functionname)
+        if histograms is None:
+            histograms = tuple([self.gethistogram('%s%s' % (prefix, functionname)) 
+                for prefix in ('parse', 'check', 'got')])
+            self.commandhistograms[functionname] = histograms
+        return histograms
+        
+    def gethistogram(self, name):
+        '''Return the histogram with name from self.histograms, creating it if
+        necessary'''
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+        
+    def getlistmessage(self, name):
+        '''Return the message listing users for name (NickList, OpList, or
+        UserIPList), formatted by the format function for name
+        
+        Messages are cached in self.listmessages, so users asking for the same
+        list share a single string.  The cache must be cleared whenever users
+        log in or leave or ops are added or removed.
+        '''
+        message = self.listmessages.get(name)
+        if message is None:
+            message = self.listmessages[name] = getattr(self, 'format%s' % name)()
+        return message
+        
+    def getmetrics(self):
+        '''Return the current values of the hub's counters and gauges, and the
+        hub's histograms, as two dictionaries by name
+        
+        The histograms include the time taken by the parse*, check*, got*, 
+        and give* functions, the time each command waited in the queue 
+        (queuedelay*), each pass through the main loop (looptick), waiting 
+        for the sockets (pollwait), how late timers ran (timerlag), and
+        compressing ZPipe blocks (zpipecompress).  The rejected* counters count
+        commands dropped for each reason, and the zpipebytes* counters the data
+        before and after compressing.
+        '''
+        values = self.counters.copy()
+        clients = self.sockets.values()
+        outgoing = [user.outgoing.size for user in clients]
+        values.update({'users':len(self.users), 'connections':len(clients),
+            'ops':len(self.ops), 'bots':len(self.bots),
+            'readyusers':len(self.ready), 'closingusers':len(self.closing),
+            'timers':len(self.timers),
+            'queuedcommands':sum([len(user.incoming) for user in clients]), 
+            'outgoingbytes':sum(outgoing), 'maxoutgoingbytes':max(outgoing + [0])})
+        return values, self.histograms
+        
+    def getmyinfos(self, client):
+        '''Return the messages giving client the MyINFO for every user
+        
+        Segments of the MyINFO snapshot where client can see every user are
+        returned as the snapshot's shared strings, others with only the
+        MyINFO of client's friends.
+        '''
+        ''' SSP: '''
+        messages = []
+        for entries, joined in self.myinfos.segments():
+            friends = [myinfo for user, myinfo in entries 
+                if user is client or client.fbConnIface.isFriend(user.fbUid) is True]
+            if len(friends) == len(entries):
+                messages.append(joined)
+            elif friends:
+                messages.append(''.join(friends))
+        return messages
+        
+    def getnicklist(self, user):
+        '''Return the NickList message with the users that user can see'''
+        ''' SSP: '''
+        friendList  = []
+        for dcUser in self.users.iterkeys():
+            if dcUser == user.nick or user.fbConnIface.isFriend(self.users[ dcUser ].fbUid) is True:
+                friendList.append(dcUser)
+        # Users that can see everyone share the cached nick list
+        if len(friendList) == len(self.users):
+            return self.getlistmessage('NickList')
+        return self.nmdcformats['NickList'] % '$$'.join(friendList)
+        
+    def getqueuedelayhistogram(self, functionname):
+        '''Return the histogram of the time commands of a type waited in the
+        queue, cached in self.queuedelayhistograms
+        
+        Commands the hub doesn't know share the queuedelayunknown histogram,
+        and aren't cached, so clients can't fill the cache with made up
+        command types.
+        '''
+        histogram = self.queuedelayhistograms.get(functionname)
+        if histogram is None:
+            if not hasattr(self, 'got%s' % functionname):
+                return self.gethistogram('queuedelayunknown')
+            histogram = self.queuedelayhistograms[functionname] = self.gethistogram('queuedelay%s' % functionname)
+        return histogram
+        
     def getuidgid(self):
         '''Get the user or group id for given name'''
         results = []
@@ -445,15 +1576,33 @@ class DCHub(object):
         return command['command']
         
     def getusercommands(self, user):
-        '''Return command string containing all commands the user has access to'''
-        commands = self.usercommands.values()
-        commands.sort(lambda uc1, uc2: cmp(uc1['position'], uc2['position']))
-        # Remove all previous user commands for the user
-        message = '$UserCommand 255 7 |'
-        for command in commands:
-            message += self.getusercommand(user, command)
+        '''Return command string containing all commands the user has access to
+        
+        Which commands the user has access to only depends on whether they are
+        logged in and an op, their account's args, and the bots in the hub,
+        so the string is cached in self.usercommandmessages for each
+        combination of the first three.  The args are part of the key as a
+        string copied from the account, so the key stays hashable and changing
+        an account's args just gives another key.  The cache is cleared when
+        the user commands are loaded or the bots change.
+        '''
+        account = self.accounts.get(user.nick)
+        key = (user.nick in self.users, user.nick in self.ops, account and str(account['args']))
+        message = self.usercommandmessages.get(key)
+        if message is None:
+            # Remove all previous user commands for the user
+            message = '$UserCommand 255 7 |' + ''.join([self.getusercommand(user, command) 
+                for command in self.sortedusercommands])
+            self.usercommandmessages[key] = message
         return message
         
+    def getwelcomemessage(self):
+        '''Return the welcome message, formatted once for each welcome text'''
+        key = (self.version, self.welcome)
+        if self.welcomemessage is None or self.welcomemessage[0] != key:
+            self.welcomemessage = (key, self.nmdcformats['WelcomeMessage'] % key)
+        return self.welcomemessage[1]
+        
     def handleconnections(self):
         '''Handle all socket connections
         
@@ -462,12 +1611,22 @@ class DCHub(object):
         their error condition set, accept new socket connections, break
         incoming data into discrete commands, put commands in user's incoming
         queue. Send data to writeable sockets.
+        
+        Sockets are registered with the poller when they are added and
+        removed, and only checked for writeability while they have data in
+        their outgoing queue, so the cost of waiting doesn't depend on the
+        number of idle connections (unless the select poller is used).  The
+        poller waits until the next timer is due, or at most polltimeout
+        seconds.
         '''
-        users = self.sockets.values()
-        timeout = 1
-        readsockets = self.listensocks.keys() + [user.socketid for user in users]
-        writesockets = [user.socketid for user in users if user.outgoing]
-        readsockets, writesockets, errorsockets = select(readsockets, writesockets, readsockets + writesockets, timeout)
+        if self.ready:
+            # Users still have commands waiting, so don't wait at all
+            timeout = 0
+        else:
+            timeout = self.timers.nexttimeout(time.time(), self.polltimeout)
+        start = time.time()
+        readsockets, writesockets, errorsockets = self.poller.poll(timeout)
+        self.gethistogram('pollwait').add(time.time() - start)
         self.handleerrorsockets(errorsockets)
         self.handlereadsockets(readsockets)
         self.handlewritesockets(writesockets)
@@ -477,49 +1636,114 @@ class DCHub(object):
         for id in errorsockets:
             if id in self.listensocks:
                 self.log.error('Error in listening socket %s, closing socket' % self.listensocks[id].getsockname())
+                self.poller.unregister(id)
                 self.listensocks[id].close()
                 del self.listensocks[id]
-            else:
+            elif self.metricslistensock is not None and id == self.metricslistensock.fileno():
+                self.log.error('Error in metrics listening socket %s, closing socket' % (self.metricslistensock.getsockname(),))
+                self.poller.unregister(id)
+                self.metricslistensock.close()
+                self.metricslistensock = None
+            elif id in self.sockets:
                 self.removeuser(self.sockets[id])
+            elif id in self.metricsconnections:
+                self.closemetricsconnection(self.metricsconnections[id])
+        
+    def handlemetricssocket(self, id, write=False):
+        '''Handle the metrics listener and connections to it
+        
+        Each connection gets a single response, sent once the end of the 
+        request headers has been received, and is then closed.  Connections
+        are closed if they stay open longer than metricstimeout.
+        '''
+        if self.metricslistensock is not None and id == self.metricslistensock.fileno():
+            while True:
+                try:
+                    connection = MetricsConnection(self.metricslistensock.accept())
+                except socket.error, error:
+                    if error.args[0] not in blockingerrors:
+                        self.debugexception('Error accepting metrics connection', self.loglevels['socketerror'])
+                    break
+                connection.socket.setblocking(0)
+                self.metricsconnections[connection.socketid] = connection
+                self.poller.register(connection.socketid)
+                self.timers.schedule(('metrics', connection), time.time() + self.metricstimeout, 'closemetricsconnection', connection)
+            return
+        connection = self.metricsconnections.get(id)
+        if connection is None:
+            return
+        try:
+            if write:
+                if connection.outgoing:
+                    connection.outgoing.consume(connection.socket.send(connection.outgoing.nextchunk()))
+                if not connection.outgoing:
+                    self.closemetricsconnection(connection)
+                return
+            data = connection.socket.recv(4096)
+            # Once the request has been answered, anything else the client
+            # sends (or closing its side of the connection) is ignored, and
+            # the connection is closed after the response has been sent
+            if connection.answered:
+                return
+            if not data:
+                return self.closemetricsconnection(connection)
+            connection.request += data
+            if '\r\n\r\n' in connection.request or '\n\n' in connection.request:
+                connection.answered = True
+                connection.outgoing.append(self.metricsresponse(connection.request))
+                self.poller.modify(id, True)
+            elif len(connection.request) > 8192:
+                self.closemetricsconnection(connection)
+        except socket.error, error:
+            if error.args[0] not in blockingerrors:
+                self.log.log(self.loglevels['socketerror'], 'Error on metrics connection %s' % connection.idstring)
+                self.closemetricsconnection(connection)
         
     def handlereadsockets(self, readsockets):
         '''Read data from sockets, accept new connections'''
         curtime = time.time()
         for id in readsockets:
             if id in self.listensocks:
-                # New socket connection, accept and add to hub
-                try:
-                    self.adduser(DCHubClient(self.listensocks[id].accept()))
-                except:
-                    self.debugexception('Error adding user', self.loglevels['useradderror'])
+                # New socket connections, accept all pending connections and
+                # add them to hub
+                listensock = self.listensocks[id]
+                while True:
+                    try:
+                        connection = listensock.accept()
+                    except socket.error, error:
+                        if error.args[0] not in blockingerrors:
+                            self.debugexception('Error accepting connection', self.loglevels['useradderror'])
+                        break
+                    try:
+                        self.adduser(DCHubClient(connection))
+                    except:
+                        self.debugexception('Error adding user', self.loglevels['useradderror'])
                 continue
             try:
                 user = self.sockets[id]
             except KeyError:
+                self.handlemetricssocket(id)
                 continue
+            incoming = user.incoming
+            queued = len(incoming)
             try: 
-                data = user.socket.recv(self.buffersize)
-                if not data:
+                size = incoming.recv(user.socket, user.limits['maxcommandsize'], curtime)
+                if not size:
                     self.log.log(self.loglevels['userdisconnect'], "Client disconnected: %s" % user.idstring)
                     self.removeuser(user)
                     continue
-                self.log.log(self.loglevels['datareceived'], 'Data received from %s: %r' % (user.idstring, data))
-            except socket.error:
+                self.counters['bytesreceived'] += size
+                if self.tracelevels['datareceived']:
+                    self.log.log(self.tracelevels['datareceived'], 'Data received from %s: %r' % (user.idstring, incoming.received(size)))
+            except socket.error, error:
+                if error.args[0] in blockingerrors:
+                    continue
                 self.log.log(self.loglevels['socketerror'], "Removing connection due to error in receiving data: %s" % user.idstring)
                 self.removeuser(user)
                 continue
-            except socket.timeout:
-                self.log.log(self.loglevels['socketerror'], 'Timeout while reading from socket for user %s' % user.idstring)
-                continue
-            # Split data into commands
-            # Note that if the data ends with '|', commands[-1] will be ''
-            commands = data.split('|')
-            # First and last commands may be incomplete. Make first command
-            # complete by pasting to the end of previous incomplete command
-            commands[0] = user.incoming.pop() + commands[0]
-            # Add commands to user's incoming command queue
-            user.incoming.extend(commands)
-            user.commandtimes.extend([curtime] * (len(commands) - 1))
+            if len(incoming) > queued:
+                user.commandtimes.add(curtime, len(incoming) - queued)
+                self.ready[id] = user
   
     def handlereloaderror(self):
         '''Reset variables that allow the hub to continue operating'''
@@ -530,24 +1754,44 @@ class DCHub(object):
         self.loadbots()
         self.log.exception('Error reloading hub')
         
+    def handletimers(self, curtime):
+        '''Call the functions for all timers that are due'''
+        timerlag = self.gethistogram('timerlag')
+        for deadline, functionname, args in self.timers.expire(curtime):
+            timerlag.add(curtime - deadline)
+            try:
+                getattr(self, functionname)(*args)
+            except:
+                self.log.exception('Error running timer %s for %r' % (functionname, args))
+        
     def handlewritesockets(self, writesockets):
         '''Write data to sockets'''
         for id in writesockets:
             try:
                 user = self.sockets[id]
             except KeyError:
+                self.handlemetricssocket(id, write=True)
+                continue
+            if not user.outgoing:
+                self.poller.modify(id, False)
                 continue
             try: 
-                sentsize = user.socket.send(user.outgoing)
-                self.log.log(self.loglevels['datasent'], 'Data sent to %s: %r' % (user.idstring, user.outgoing[:sentsize]))
-            except socket.error:
+                if self.zpipethreshold and 'ZPipe0' in user.supports:
+                    self.zpipecompress(user)
+                data = user.outgoing.nextchunk()
+                sentsize = user.socket.send(data)
+                self.counters['bytessent'] += sentsize
+                if self.tracelevels['datasent']:
+                    self.log.log(self.tracelevels['datasent'], 'Data sent to %s: %r' % (user.idstring, data[:sentsize]))
+            except socket.error, error:
+                if error.args[0] in blockingerrors:
+                    continue
                 self.log.log(self.loglevels['socketerror'], "Removing connection due to error in sending data: %s" % user.idstring)
                 self.removeuser(user)
                 continue
-            except socket.timeout:
-                self.log.log(self.loglevels['socketerror'], 'Timeout while writing to socket for user %s' % user.idstring)
-                continue
-            user.outgoing = user.outgoing[sentsize:]
+            user.outgoing.consume(sentsize)
+            if not user.outgoing:
+                self.poller.modify(id, False)
                 
     def hubfullcheck(self, user):
         '''Checks if the hub is full, and either denies access or redirects
@@ -572,14 +1816,27 @@ class DCHub(object):
     def joinfloodcheck(self, user, type='nick'):
         '''Check that the join flood limits aren't being violated'''
         curtime = time.time()
-        self.jointimes = [jointime for jointime in self.jointimes if jointime[0] > curtime - self.joinfloodtime]
-        joins = [jointime[1] for jointime in self.jointimes]
+        joins = self.jointimes[type]
+        joins.expire(curtime - self.joinfloodtime)
         checkattr = getattr(user, type)
         if checkattr in joins:
             self.removeuser(user)
             raise ValueError, 'join flood detected'
-        self.jointimes.append((curtime, checkattr))
+        joins.add(checkattr, curtime)
                 
+    def keepalive(self, user):
+        '''Send an empty command to user if nothing was sent or received lately
+        
+        Called by the user's keepalive timer, which is only rescheduled when
+        it goes off, instead of every time the user sends or receives a
+        command, so idle users don't cost anything between keepalives.
+        '''
+        if user.ignoremessages or self.sockets.get(user.socketid) is not user:
+            return
+        if user.lastcommandtime <= time.time() - user.limits['pingtime']:
+            self.give_EmptyCommand(user)
+        self.timers.schedule(('keepalive', user), user.lastcommandtime + user.limits['pingtime'], 'keepalive', user)
+        
     def loadaccounts(self):
         '''Load accounts from file'''
         if not os.path.isfile(self.accountsfile):
@@ -653,10 +1910,12 @@ class DCHub(object):
                     self.debugexception('Error closing bot %s' % bot.idstring, self.loglevels['boterror'])
                 continue
             self.bots[bot.nick] = bot
+            self.usercommandmessages.clear()
             # Modify hub functions as requested by the bot
             for functionname, function in bot.replace.items():
                 self.replacedfunctions[functionname] = getattr(self, functionname)
                 setattr(self, functionname, function)
+                self.commandfunctions.clear()
             for functionname, function in bot.execbefore.items():
                 self.wrapfunction(functionname, function, execbefore=True)
             for functionname, function in bot.execafter.items():
@@ -668,9 +1927,11 @@ class DCHub(object):
                     self.removeuser(self.nicks[bot.nick])
                 self.nicks[bot.nick] = bot
                 self.users[bot.nick] = bot
+                self.myinfos.add(bot)
                 if bot.op:
                     opsadded = True
                     self.ops[bot.nick] = bot
+                self.listmessages.clear()
                 self.log.log(self.loglevels['userlogin'], 'Bot logged in: %s' % bot.idstring)
                 self.giveHello(bot, newuser=True)
                 self.giveMyINFO(bot)
@@ -701,7 +1962,7 @@ class DCHub(object):
                 for key, value in self.configparser.items('dchub'):
                     if key not in config:
                         config[key] = value
-            for section in 'userlimits', 'loglevels':
+            for section in 'userlimits', 'loglevels', 'commandcosts':
                 sectiondict = getattr(self, section)
                 if self.configparser.has_section('dchub-%s' % section):
                     for key, value in self.configparser.items('dchub-%s' % section):
@@ -773,6 +2034,7 @@ class DCHub(object):
             return self.debugexception('Error loading user commands', self.loglevels['loadfileerror'])
         self.usercommands.clear()
         self.usercommands.update(usercommands)
+        self.sortusercommands()
         self.log.log(self.loglevels['loading'], 'Loaded %s user commands' % len(usercommands.keys()))
         self.log.log(self.loglevels['loadingdebug'], 'Loaded user commands: %s' % ' '.join(usercommands.keys()))
             
@@ -802,27 +2064,43 @@ class DCHub(object):
         curtime = time.time()
         user.validcommands = self.validusercommands.copy()
         self.users[user.nick] = user
+        self.myinfos.add(user)
+        self.listmessages.clear()
         user.loggedin = True
         self.log.log(self.loglevels['userlogin'], 'User logged in: %s' % user.idstring)
-        self.giveHello(user, newuser=True)
-        if 'NoGetINFO' in user.supports:
-            self.giveMyINFO(user, newuser=True)
-        else:
-            self.giveMyINFO(user)
-        if 'NoHello' not in user.supports and user.givenicklist:
-            user.givenicklist = False
-            self.giveNickList(user)
-        if user.nick in self.accounts:
-            user.account = self.accounts[user.nick]
-            if self.accounts[user.nick]['op']:
-                user.validcommands |= self.validopcommands
-                self.ops[user.nick] = user
-                user.op = True
-                self.giveOpList()
-        if self.ops and not user.op:
-            self.giveOpList(user)
-        self.give_WelcomeMessage(user)
-        self.giveUserCommand(user)
+        # Everything the new user is given while logging in is queued at
+        # once, mostly as messages shared with other logins, and sent right
+        # away
+        user.startbatch()
+        try:
+            self.giveHello(user, newuser=True)
+            if 'NoGetINFO' in user.supports:
+                self.giveMyINFO(user, newuser=True)
+            else:
+                self.giveMyINFO(user)
+            if 'NoHello' not in user.supports and user.givenicklist:
+                user.givenicklist = False
+                self.giveNickList(user)
+            if user.nick in self.accounts:
+                user.account = self.accounts[user.nick]
+                if self.accounts[user.nick]['op']:
+                    user.validcommands |= self.validopcommands
+                    self.ops[user.nick] = user
+                    self.listmessages.clear()
+                    user.op = True
+                    self.giveOpList()
+            if self.ops and not user.op:
+                self.giveOpList(user)
+            self.give_WelcomeMessage(user)
+            self.giveUserCommand(user)
+        finally:
+            user.endbatch(curtime)
+        if self.sockets.get(user.socketid) is user:
+            self.handlewritesockets([user.socketid])
+        # Sending can fail and remove the user, and subclasses shouldn't
+        # continue logging in a removed user
+        if self.sockets.get(user.socketid) is not user:
+            raise ValueError, 'Connection lost while logging in'
         
     def logtimes(self, functionname, loglevel, warningtime, warninglevel=logging.WARNING):
         '''Log timing information for every call to function with name
@@ -834,21 +2112,52 @@ class DCHub(object):
         '''
         oldfunction = getattr(self, functionname)
         setattr(self, functionname, self._timerwrapper(oldfunction, loglevel, warningtime, warninglevel))
+        self.commandfunctions.clear()
         if functionname not in self.wrappedfunctions:
             self.wrappedfunctions[functionname] = oldfunction
         
+    def makeready(self, user):
+        '''Have processcommands process the user's queued commands again'''
+        if user.incoming.commands and self.sockets.get(user.socketid) is user:
+            self.ready[user.socketid] = user
+            
     def mainloop(self):
         '''Continuously process, send, and receive data from socket connections'''
         self.setuplisteningsockets()
         self.log.log(self.loglevels['hubstatus'], 'Starting main loop')
+        looptick = self.gethistogram('looptick')
         while not self.stop:
             try:
+                start = time.time()
                 self.processcommands()
                 self.handleconnections()
+                looptick.add(time.time() - start)
             except: 
                 self.log.exception('Serious error in main control loop')
         self.cleanup()
         
+    def measuregivefunctions(self):
+        '''Record the time taken by every give* function in self.histograms
+        
+        This is done before the bots are loaded, so that restoring the hub's
+        functions when reloading the bots restores the measured versions.
+        Functions that bots replace aren't measured.
+        '''
+        for name in dir(self):
+            if name.startswith('give') and callable(getattr(self, name)):
+                setattr(self, name, self._histogramwrapper(getattr(self, name), self.gethistogram(name)))
+        
+    def metricsresponse(self, request):
+        '''Return the HTTP response for a request to the metrics listener'''
+        requestline = request.split('\n', 1)[0].split()
+        if len(requestline) >= 2 and requestline[0] in ('GET', 'HEAD') and requestline[1].split('?')[0] == '/metrics':
+            status, contenttype, body = '200 OK', 'text/plain; version=0.0.4', self.formatprometheus()
+        else:
+            status, contenttype, body = '404 Not Found', 'text/plain', 'Not Found\n'
+        if requestline[:1] == ['HEAD']:
+            return httpresponseformat % (status, contenttype, len(body), '')
+        return httpresponseformat % (status, contenttype, len(body), body)
+        
     def postreload(self):
         '''Commands to preform after reloading the hub
         
@@ -856,6 +2165,9 @@ class DCHub(object):
         the reloaded hub has entered its main loop.
         '''
         self.log = self.kwargs['oldhub'].log
+        defaults = dict([(name, getattr(self, name).copy()) for name in ('userlimits', 'loglevels', 'commandcosts', 'counters')])
+        opcommands = self.validopcommands
+        supports = self.supports
         for key in self.kwargs['oldhub'].__dict__:
             if hasattr(self, key) and (callable(getattr(self, key)) or key in self.nonreloadableattrs):
                 continue
@@ -866,82 +2178,258 @@ class DCHub(object):
             self.listensocks[self.kwargs['oldhub'].listensock.fileno()] = self.kwargs['oldhub'].listensock
         if not self.bindinglocations:
             self.bindinglocations.append((self.ip, self.port))
-        
+        # Limits, log levels, command costs, and counters added since the 
+        # version being reloaded from
+        for name, sectiondict in defaults.iteritems():
+            for key, value in sectiondict.iteritems():
+                getattr(self, name).setdefault(key, value)
+        # Op commands added since the version being reloaded from
+        self.validopcommands |= opcommands
+        # Extensions added since the version being reloaded from
+        self.supports.extend([feature for feature in supports if feature not in self.supports])
+        self.refreshtracelevels()
+        # Fix for reloading from versions without a MyINFO snapshot
+        if not self.myinfos:
+            for user in self.users.itervalues():
+                self.myinfos.add(user)
+        # Fix for reloading from versions without sorted user commands
+        if self.usercommands and not self.sortedusercommands:
+            self.sortusercommands()
+        # Fix for reloading from versions with a list of join times
+        if isinstance(self.jointimes, list):
+            jointimes = {'ip':ExpiringIndex(), 'nick':ExpiringIndex()}
+            # The list didn't record whether each join was by IP or by nick
+            for jointime, checkattr in self.jointimes:
+                for joins in jointimes.itervalues():
+                    joins.add(checkattr, jointime)
+            self.jointimes = jointimes
+        # Formats added since the version being reloaded from
+        for name, format in nmdcformats.iteritems():
+            self.nmdcformats.setdefault(name, format)
+        # Fixes for reloading from versions without pollers or non-blocking
+        # sockets, or with unordered ready users
+        curtime = time.time()
+        if not isinstance(self.ready, OrderedDict):
+            self.ready = OrderedDict(self.ready)
+        if self.poller is None:
+            self.setuppoller()
+        for sock in self.listensocks.itervalues():
+            sock.setblocking(0)
+        for user in self.sockets.itervalues():
+            # Clients keep the class from the module the old hub was using,
+            # which may be missing methods the reloaded hub calls
+            if user.__class__ is not DCHubClient and user.__class__.__name__ == DCHubClient.__name__:
+                user.__class__ = DCHubClient
+            # ignoremessages is a property of clients in newer versions
+            if 'ignoremessages' in user.__dict__:
+                user._ignoremessages = user.__dict__.pop('ignoremessages')
+            user.socket.setblocking(0)
+            user.poller = self.poller
+            if not isinstance(user.incoming, IncomingBuffer):
+                incoming = IncomingBuffer(self.buffersize)
+                if isinstance(user.incoming, list):
+                    commands, partial = user.incoming[:-1], user.incoming[-1]
+                else:
+                    commands, partial = user.incoming.commands, user.incoming.partial
+                incoming.commands.extend(commands)
+                incoming.arrivals.extend(getattr(user.incoming, 'arrivals', [curtime] * len(commands)))
+                incoming.partial.extend(partial)
+                user.incoming = incoming
+            if not isinstance(user.outgoing, OutgoingBuffer):
+                outgoing = OutgoingBuffer()
+                if isinstance(user.outgoing, str):
+                    outgoing.append(user.outgoing)
+                else:
+                    chunks = list(user.outgoing.chunks)
+                    if chunks and user.outgoing.offset:
+                        chunks[0] = chunks[0][user.outgoing.offset:]
+                    outgoing.extend(chunks)
+                user.outgoing = outgoing
+            # Fix for reloading from versions with lists for rate limiting
+            if isinstance(user.recentmessages, list):
+                recentmessages = SlidingWindow(2)
+                for messageinfo in user.recentmessages:
+                    recentmessages.add(*messageinfo)
+                user.recentmessages = recentmessages
+                commandtimes = SlidingWindow(1)
+                for commandtime in user.commandtimes:
+                    commandtimes.add(commandtime, 1)
+                user.commandtimes = commandtimes
+                for name in 'searchtimes', 'myinfotimes':
+                    window = SlidingWindow()
+                    for eventtime in getattr(user, name):
+                        window.add(eventtime)
+                    setattr(user, name, window)
+            # Fix for reloading from versions without command costs
+            if not hasattr(user, 'costs'):
+                user.costs = SlidingWindow(1)
+            if not hasattr(user, 'limits'):
+                user.limits = {}
+            for key, value in self.userlimits.iteritems():
+                user.limits.setdefault(key, value)
+            # Fix for reloading from versions without ready and closing users
+            user.closing = self.closing
+            user.log, user.tracelevels = self.log, self.tracelevels
+            if user.ignoremessages:
+                self.closing[user.socketid] = user
+            elif user.incoming.commands:
+                self.ready[user.socketid] = user
+            # Fix for reloading from versions without timers
+            if ('keepalive', user) not in self.timers.timers:
+                self.timers.schedule(('keepalive', user), user.lastcommandtime + user.limits['pingtime'], 'keepalive', user)
+        
+        self.measuregivefunctions()
         self.loadbots()
         self.log.log(self.loglevels['hubstatus'], 'Hub Reloaded')
                     
-    def processcommand(self, user, command):
+    def processcommand(self, user, command, queuedelay=None):
         '''Process command for user
         
         Check that the command is valid, check that user has permission to use
         the command, parse the commands args, check that the args are valid
-        for the command and user, execute the command.
+        for the command and user, execute the command.  If queuedelay is
+        given, it is recorded as the time the command waited in the queue.
         '''        
-        print command
+        if self.tracelevels['commandtrace']:
+            self.log.log(self.tracelevels['commandtrace'], 'Command from %s: %r' % (user.idstring, command))
         if not command:
+            if queuedelay is not None:
+                self.getqueuedelayhistogram('_EmptyCommand').add(queuedelay)
             return self.got_EmptyCommand(user)
+        function, args = self.getcommandtype(command)
+        if queuedelay is not None:
+            self.getqueuedelayhistogram(function).add(queuedelay)
         if self.badcommand(user, command):
+            self.counters['rejectedbadcommand'] += 1
             return self.log.log(self.loglevels['badcommand'], 'Bad command from %s: %r' % (user.idstring, command))
-        
-        function, args = self.getcommandtype(command)
         if self.badprivileges(user, function, args):
+            self.counters['rejectedprivileges'] += 1
             return self.log.log(self.loglevels['badcommand'], '%s lacks privilege for command: %r' % (user.idstring, command))
+        if not self.chargecost(user, function, command):
+            self.counters['rejectedcost'] += 1
+            if function == '_ChatMessage' and self.notifyspammers:
+                self.give_SpamNotification(user, args)
+            return self.log.log(self.loglevels['badcommand'], 'Command over cost budget from %s: %r' % (user.idstring, command))
         try:
-            parsedargs = getattr(self, 'parse%s' % function)(user, args)
+            parse, check, got, bad = self.getcommandfunctions(function)
+        except AttributeError:
+            return self.debugexception('Missing functions for command %s, user %s' % (function, user.idstring), self.loglevels['commanderror'])
+        parsetimes, checktimes, gottimes = self.getcommandhistograms(function)
+        tim = time.time
+        start = tim()
+        try:
+            parsedargs = parse(user, args)
         except:
             self.debugexception('Error parsing args for function parse%s, user %s, args %r' % (function, user.idstring, args), self.loglevels['commanderror'])
-            return getattr(self, 'bad%s' % function)(user, args)
+            self.counters['rejectedparse'] += 1
+            return bad(user, args)
+        end = tim()
+        parsetimes.add(end - start)
         if parsedargs is None:
             return
         try:
-            checkedargs = getattr(self, 'check%s' % function)(user, *parsedargs)
+            checkedargs = check(user, *parsedargs)
         except:
             self.debugexception('Error checking args for function check%s, user %s, args %r' % (function, user.idstring, args), self.loglevels['commanderror'])
-            return getattr(self, 'bad%s' % function)(user, args, parsedargs)
+            self.counters['rejectedcheck'] += 1
+            return bad(user, args, parsedargs)
+        start = tim()
+        checktimes.add(start - end)
         if checkedargs is False:
             return
         if checkedargs is None:
             checkedargs = parsedargs
-        getattr(self, 'got%s' % function)(user, *checkedargs)
+        got(user, *checkedargs)
+        gottimes.add(tim() - start)
             
     def processcommands(self):
         '''Process next command for all users
         
         Remove users if they have been set to ignore messages and their
-        outgoing message queue has been flushed.  Also send a keep alive to
-        users that haven't sent a command in a while.
+        outgoing message queue has been flushed.  Also run any timers that
+        are due (such as keep alives for users that haven't sent a command in
+        a while).
+        
+        Only users in self.closing (users set to ignore messages) and 
+        self.ready (users with queued commands) are checked, so idle users
+        don't cost anything.  Users that have sent too many commands recently
+        are taken out of self.ready, and put back by a timer once they are
+        allowed to send commands again.
+        
+        Each ready user gets a turn to process at most commandsperround 
+        commands, and then goes to the back of self.ready if they have more 
+        commands queued, so users sending lots of commands don't delay 
+        everyone else.  If roundtime is not 0, processing stops once it has 
+        taken roundtime seconds (after at least one command), and continues
+        with the next user on the next call.  The hub counts as saturated
+        until a call finishes within roundtime.  The time commands spent waiting in the queue is recorded
+        by type in self.histograms.
         '''
         curtime = time.time()
-        # self.sockets.itervalues() doesn't work here because users can be
-        # removed in many of the sub functions, and that modifies the 
-        # self.sockets dictionary.  This could be worked around by not removing
-        # any users until after the processing of commands, but that would 
-        # require significant changes, and probably wouldn't be worth it except
-        # for the largest sites
-        for user in self.sockets.values():
+        if self.tracestate != (self.loglevels, self.log.getEffectiveLevel(), logging.root.manager.disable):
+            self.refreshtracelevels()
+        self.handletimers(curtime)
+        # self.closing.itervalues() and self.ready.itervalues() don't work here
+        # because users can be removed in many of the sub functions, and that
+        # modifies the dictionaries.
+        for user in self.closing.values():
+            if not user.outgoing:
+                self.removeuser(user)
+        ready, commandsperround = self.ready, self.commandsperround
+        endtime = curtime + self.roundtime
+        # Whether this round runs out of time is only known at the end, so
+        # the hub cost limit during the round depends on the previous round
+        saturated = False
+        for i in xrange(len(ready)):
+            if not ready:
+                break
+            now = time.time()
+            if self.roundtime and i and now > endtime:
+                saturated = True
+                break
+            socketid, user = ready.popitem(last=False)
             if user.ignoremessages:
-                if not user.outgoing:
-                    self.removeuser(user)
                 continue
-            incominglen = len(user.incoming)
-            if incominglen > 1:
-                if incominglen > user.limits['maxqueuedcommands']:
-                    self.log.log(self.loglevels['badcommand'], 'User has more than the max number of queued commands (%i queued, %i max): %s' % (incominglen, user.limits['maxqueuedcommands'], user.idstring))
-                    del user.incoming[user.limits['maxqueuedcommands'] - 1:-1]
-                user.lastcommandtime = curtime
-                commandtime = curtime - user.limits['timeperiod']
-                user.commandtimes = [ct for ct in user.commandtimes if ct > commandtime]
-                if len(user.commandtimes) > user.limits['maxcommandspertimeperiod']:
-                    continue
-                try: 
-                    while len(user.incoming) > 1 and not user.ignoremessages:
-                        command = user.incoming.pop(0)
-                        self.processcommand(user, command)
-                except:
-                    self.log.exception('Error processing command from %s: %r' % (user.idstring, command))
-            elif user.lastcommandtime < curtime - user.limits['pingtime']:
-                self.give_EmptyCommand(user)
+            incoming = user.incoming
+            incominglen = len(incoming)
+            if incominglen > user.limits['maxqueuedcommands']:
+                self.log.log(self.loglevels['badcommand'], 'User has more than the max number of queued commands (%i queued, %i max): %s' % (incominglen, user.limits['maxqueuedcommands'], user.idstring))
+                incoming.discard(incominglen - user.limits['maxqueuedcommands'])
+                self.counters['rejectedqueuefull'] += incominglen - user.limits['maxqueuedcommands']
+            user.lastcommandtime = curtime
+            user.commandtimes.expire(curtime - user.limits['timeperiod'])
+            if user.commandtimes.totals[0] > user.limits['maxcommandspertimeperiod']:
+                self.timers.schedule(('ready', user), user.commandtimes.oldest() + user.limits['timeperiod'], 'makeready', user)
+                continue
+            try: 
+                for j in xrange(commandsperround):
+                    if not incoming or user.ignoremessages:
+                        break
+                    command, received = incoming.popleft()
+                    self.processcommand(user, command, now - received)
+                    if self.roundtime and time.time() > endtime:
+                        saturated = True
+                        break
+            except:
+                self.log.exception('Error processing command from %s: %r' % (user.idstring, command))
+            if incoming and not user.ignoremessages and self.sockets.get(socketid) is user:
+                ready[socketid] = user
+            if saturated:
+                break
+        self.saturated = saturated
                 
+    def refreshtracelevels(self):
+        '''Recalculate which log messages in self.loglevels will be logged
+        
+        self.tracelevels is updated in place, since users share it.
+        '''
+        tracelevels = {}
+        for name, level in self.loglevels.iteritems():
+            tracelevels[name] = self.log.isEnabledFor(level) and level or 0
+        self.tracelevels.clear()
+        self.tracelevels.update(tracelevels)
+        self.tracestate = (self.loglevels.copy(), self.log.getEffectiveLevel(), logging.root.manager.disable)
+        
     def reload(self):
         '''Stop the hub's main loop and mark it to be reloaded'''
         self.log.log(self.loglevels['hubstatus'], 'Reloading Hub')
@@ -954,6 +2442,15 @@ class DCHub(object):
         if hasattr(user, 'socketid') and user.socketid in self.sockets \
           and self.sockets[user.socketid] is user:
             del self.sockets[user.socketid]
+            self.poller.unregister(user.socketid)
+            user.poller = None
+        if hasattr(user, 'socketid'):
+            for place in self.ready, self.closing:
+                if place.get(user.socketid) is user:
+                    del place[user.socketid]
+        self.timers.cancel(('keepalive', user))
+        self.timers.cancel(('login', user))
+        self.timers.cancel(('ready', user))
             
         try: 
             user.close()
@@ -961,13 +2458,17 @@ class DCHub(object):
             self.log.exception('Error executing user.close for %s' % user.idstring)
         if user.nick in self.bots and self.bots[user.nick] is user:
             del self.bots[user.nick]
+            self.usercommandmessages.clear()
         if user.nick in self.nicks and self.nicks[user.nick] is user:
             del self.nicks[user.nick]
         if user.nick in self.users and self.users[user.nick] is user:
             del self.users[user.nick]
+            self.myinfos.remove(user)
+            self.listmessages.clear()
             self.giveQuit(user)
         if user.nick in self.ops and self.ops[user.nick] is user:
             del self.ops[user.nick]
+            self.listmessages.clear()
         user.loggedin = False
         user.op = False
         
@@ -977,15 +2478,32 @@ class DCHub(object):
         self.id = self.__class__.id
         self.version = __version__
         self.myinfoformat = myinfoformat
+        self.nmdcformats = nmdcformats.copy()
         self.supers = {}
         self.reloadmodules = []
         self.nonreloadableattrs = set('''supers stop nonreloadableattrs 
             execbefore execafter replacedfunctions wrappedfunctions 
-            reloadonexit bots kwargs version'''.split())
+            reloadonexit bots kwargs version commandfunctions listmessages
+            welcomemessage usercommandmessages'''.split())
         self.port = 411
         self.ip = ''
         self.bindinglocations = []
         self.listensocks = {}
+        # Maximum number of pending connections on each listening socket
+        self.listenbacklog = 128
+        # Local HTTP listener for metrics in the Prometheus text format (port
+        # 0 for no listener), and the time connections to it can stay open
+        self.metricsip = '127.0.0.1'
+        self.metricsport = 0
+        self.metricstimeout = 10
+        self.metricslistensock = None
+        self.metricsconnections = {}
+        # Readiness notification backend (epoll, poll, select, or auto)
+        self.pollertype = 'auto'
+        self.poller = None
+        # Maximum time to wait for sockets to become ready, in seconds
+        self.polltimeout = 1.0
+        self.timers = TimerWheel()
         self.debug = True
         self.stop = False
         self.handleslashme = False
@@ -1002,35 +2520,80 @@ class DCHub(object):
         self.badsearchchars = ' '
         self.validsearchdatatypes = set(range(10))
         self.badnickchars = '$<>% \x09\x0A\x0D'
-        self.supports = 'NoGetINFO NoHello UserCommand UserIP2'.split()
+        self.supports = 'NoGetINFO NoHello UserCommand UserIP2 ZPipe0'.split()
+        # Data queued for users supporting ZPipe0 is compressed when at least
+        # zpipethreshold bytes are waiting to be sent (0 to never compress),
+        # at most zpipeslicesize bytes at a time, with zlib level zpipelevel
+        self.zpipethreshold = 1024
+        self.zpipeslicesize = 65536
+        self.zpipelevel = 1
         self.replacedfunctions, self.wrappedfunctions = {}, {}
+        # Cache of the parse, check, got, and bad functions for each command
+        self.commandfunctions = {}
         self.execbefore, self.execafter = {}, {}
         self.usercommands = {}
+        # User commands sorted by position, and cached messages with the user
+        # commands for each kind of user (see getusercommands)
+        self.sortedusercommands = []
+        self.usercommandmessages = {}
         self.filelocations = 'configfile accountsfile welcomefile usercommandsfile botsdir'.split()
         self.validusercommands = set('''_ChatMessage _PrivateMessage MyINFO GetINFO
             GetNickList Search SR ConnectToMe RevConnectToMe UserIP'''.split())
-        self.validopcommands = set('OpForceMove Kick Close ReloadBots'.split())
+        self.validopcommands = set('OpForceMove Kick Close ReloadBots Metrics'.split())
         self.lockstring = 'EXTENDEDPROTOCOLABCABCABCABCABCABC'
         self.privatekeystring = 'py-dchub-%s--' % self.version
         self.name = 'py-dchub'
         self.FBLoginURL = 'http://naresh.dyndns-at-home.com'
         self.hubredirectwhenfull = ''
         self.welcome = ''
+        # Cached welcome message (see getwelcomemessage)
+        self.welcomemessage = None
         # Incoming socket buffer size
         self.buffersize = 1024
         # Sockets includes all connections to the server
         # Nicks includes all users that have logged in with ValidateNick
         # Users includs all users that have sent MyINFO
         self.sockets, self.users, self.ops, self.bots = {}, {}, {}, {}
+        # MyINFO of all users, maintained as users log in, change their 
+        # MyINFO, and leave
+        self.myinfos = MyINFOSnapshot()
+        # Cached messages listing users (see getlistmessage)
+        self.listmessages = {}
+        # Ready includes connections with commands waiting to be processed
+        # Closing includes connections that are ignoring messages, and will be
+        # removed once their outgoing buffer is empty
+        self.ready, self.closing = OrderedDict(), {}
+        # Number of commands processed for each user before moving on to the
+        # next user, and maximum time spent processing commands before
+        # checking the sockets again (0 for no limit)
+        self.commandsperround = 5
+        self.roundtime = 0.1
+        # Whether the last call to processcommands ran out of time
+        self.saturated = False
+        # Histograms of the time taken by hub functions, by name (see 
+        # getmetrics), and counters of hub activity
+        self.histograms, self.commandhistograms = {}, {}
+        self.queuedelayhistograms = {}
+        self.counters = {'bytesreceived':0, 'bytessent':0, 
+            'rejectedbadcommand':0, 'rejectedprivileges':0, 'rejectedcost':0,
+            'rejectedparse':0, 'rejectedcheck':0, 'rejectedqueuefull':0,
+            'zpipebytesin':0, 'zpipebytesout':0}
         self.accounts, self.nicks = {}, {}
-        self.jointimes = []
+        # Recent joins by IP and by nick, for the join flood check
+        self.jointimes = {'ip':ExpiringIndex(), 'nick':ExpiringIndex()}
         self.loglevels = {'wrapping':10, 'datasent':1, 'datareceived':5,
             'newconnection': 10, 'useradderror': 10, 'userdisconnect': 10,
             'socketerror': 10, 'loading': 10, 'loadingdebug': 3,
             'loadfileerror': 40, 'missingfile': 30, 'boterror': 20,
             'userlogin': 10, 'hubstatus': 20, 'userremove': 10,
             'duplicatelogin': 20, 'commanderror':10, 'userloginerror':20,
-            'badcommand':5, 'execchange': 10, }
+            'badcommand':5, 'execchange': 10, 'commandtrace':2,
+            'messagetrace':1, }
+        # Levels of the log messages that will actually be logged (0 for
+        # the others), so hot paths can skip formatting messages that would
+        # be thrown away.  Refreshed by processcommands when loglevels or the
+        # log's level change.
+        self.tracelevels, self.tracestate = {}, None
         self.userlimits = {'maxcommandsize':25000, 'maxqueuedcommands':20,
             'maxcommandspertimeperiod':20, 'maxdescriptionlength':50,
             'maxtaglength':50, 'maxnicklength':25, 'maxemaillength':50,
@@ -1038,10 +2601,29 @@ class DCHub(object):
             'maxcharacterspertimeperiod':1000, 'maxmessagespertimeperiod':10,
             'maxnewlinespertimeperiod':10, 'maxsearchespertimeperiod':10,
             'maxsearchsize':500, 'maxmyinfopertimeperiod':3, 'pingtime':300,
-            'timeperiod':60}
+            'timeperiod':60, 'maxcostpertimeperiod':200}
+        # Cost of each type of command (types not listed cost 1).  Commands
+        # sent to every user (broadcastcommands) cost 1 more for every 
+        # costperusers users, and all commands cost 1 more for every 
+        # costperbytes bytes (0 to disable either).
+        self.commandcosts = {'_ChatMessage':1, '_PrivateMessage':1, 
+            'ConnectToMe':1, 'RevConnectToMe':1, 'GetINFO':1, 'GetNickList':5,
+            'MyINFO':1, 'Search':2, 'SR':1, 'UserIP':1, 'Key':0, 'Supports':0,
+            'ValidateNick':0, 'Version':0, 'MyPass':0, 'FBAuthRand':0,
+            'OpForceMove':0, 'Kick':0, 'Close':0, 'ReloadBots':0, 'Metrics':0}
+        self.broadcastcommands = set('_ChatMessage MyINFO Search'.split())
+        self.costperusers = 100
+        self.costperbytes = 1024
+        # Maximum cost per second of broadcast commands from all users, 
+        # enforced only while the hub can't keep up with incoming commands
+        # (0 for no limit)
+        self.maxhubcostpersecond = 0
+        self.hubcosts = SlidingWindow(1)
         # Hub Limits
         self.maxusers = 500
         self.joinfloodtime = 60
+        # Time allowed for new connections to log in, in seconds (0 for no limit)
+        self.logintimeout = 0
         # Unix specific options
         self.chroot = True
         self.changeuidgid = False
@@ -1054,6 +2636,11 @@ class DCHub(object):
         self.usesyslog = False
         self.sysloghost = '/dev/log'
         self.syslogfacility = 'daemon'
+        # Write log messages from a background thread, queueing at most
+        # logqueuesize messages (0 for no limit)
+        self.asynclogging = False
+        self.logqueuesize = 10000
+        self.backgroundloghandler = None
         # Default file locations
         self.configfile = 'conf'
         self.accountsfile = 'accounts'
@@ -1071,9 +2658,11 @@ class DCHub(object):
         self.loadconfig()
         self.unixconfig()
         self.setuplogging()
+        self.setuppoller()
         self.loadaccounts()
         self.loadwelcome()
         self.loadusercommands()
+        self.measuregivefunctions()
         self.loadbots()
 
     def setuplimits(self, user):
@@ -1095,6 +2684,11 @@ class DCHub(object):
                 errormsg += ' (maybe because the port is set to less than 1024 and you aren\'t running as root)'
             print errormsg
             sys.exit(1)
+        if self.metricsport:
+            try:
+                self.createmetricssocket()
+            except socket.error:
+                self.log.exception('Error setting up metrics listening socket')
         self.dropprivileges()
         
     def setuplogging(self):
@@ -1103,8 +2697,11 @@ class DCHub(object):
         Creates the stdout logger if debugging, the file logger if logging to a
         file, and the syslog handler is logging to syslog. Logging levels for
         specific types of messages can be changed by modifying the appropriate
-        item in the loglevels dictionary.
+        item in the loglevels dictionary.  If asynclogging is set, the handlers
+        are run by a BackgroundLogHandler, so the main loop doesn't wait for
+        disk or network I/O when logging.
         '''
+        handlers = []
         self.log = logging.getLogger('dchub.%s.default' % self.id)
         try:
             self.log.setLevel(logging.__dict__[self.loglevel])
@@ -1121,12 +2718,12 @@ class DCHub(object):
         if self.debug or os.name == 'nt':
             self.defaultloghandler = logging.StreamHandler(sys.stdout)
             self.defaultloghandler.setFormatter(self.defaultlogformatter)
-            self.log.addHandler(self.defaultloghandler)
+            handlers.append(self.defaultloghandler)
         if self.logfile != '':
             try:
                 self.defaultlogfilehandler = logging.FileHandler(self.logfile)
                 self.defaultlogfilehandler.setFormatter(self.defaultlogfileformatter)
-                self.log.addHandler(self.defaultlogfilehandler)
+                handlers.append(self.defaultlogfilehandler)
                 if os.name == 'posix' and self.changeuidgid:
                     os.chown(self.logfile, self.uid, self.gid)
             except:
@@ -1144,13 +2741,45 @@ class DCHub(object):
                     address = self.sysloghost
                 self.defaultsysloghandler = SysLogHandler(address , getattr(SysLogHandler, 'LOG_%s' % self.syslogfacility.upper()))
                 self.defaultsysloghandler.setFormatter(self.defaultsyslogformatter)
-                self.log.addHandler(self.defaultsysloghandler)
+                handlers.append(self.defaultsysloghandler)
             except:
                 message = 'ERROR: Setting up logging to syslog failed: '
                 if self.debug or self.logfile:
                     self.log.exception(message)
                 else:
                     print message, sys.exc_info()[1]
+        if self.asynclogging and handlers:
+            self.backgroundloghandler = BackgroundLogHandler(handlers, self.logqueuesize)
+            handlers = [self.backgroundloghandler]
+        for handler in handlers:
+            self.log.addHandler(handler)
+        self.refreshtracelevels()
+                    
+    def setuppoller(self):
+        '''Create the readiness notification backend given by pollertype
+        
+        If pollertype is auto, use the best backend the platform supports.
+        Any sockets the hub already has are registered with the new poller.
+        '''
+        pollertype = self.pollertype
+        if pollertype == 'auto':
+            for pollertype in pollertypes:
+                if hasattr(select, pollertype):
+                    break
+        elif pollertype not in pollerclasses or not hasattr(select, pollertype):
+            self.log.warning('Poller type %r not available, using select' % pollertype)
+            pollertype = 'select'
+        self.poller = pollerclasses[pollertype]()
+        self.log.log(self.loglevels['hubstatus'], 'Using %s for socket readiness notification' % self.poller.name)
+        for id in self.listensocks:
+            self.poller.register(id)
+        for user in self.sockets.itervalues():
+            user.poller = self.poller
+            self.poller.register(user.socketid, bool(user.outgoing))
+        if self.metricslistensock is not None:
+            self.poller.register(self.metricslistensock.fileno())
+        for connection in self.metricsconnections.itervalues():
+            self.poller.register(connection.socketid, bool(connection.outgoing))
                     
     def setupsignals(self):
         '''Do an orderly shutdown upon receiving a signal.
@@ -1180,18 +2809,21 @@ class DCHub(object):
             self.log.log(self.loglevels['hubstatus'], 'Reloading due to signal %s' % signum)
         self.reload()
         
+    def sortusercommands(self):
+        '''Sort the user commands by position, and clear the cached messages'''
+        commands = self.usercommands.values()
+        commands.sort(key=operator.itemgetter('position'))
+        self.sortedusercommands = commands
+        self.usercommandmessages.clear()
+        
     def stringoverlaps(self, string1, string2):
         '''Check if any character in either string is in the other string
         
-        Used for testing if strings contain illegal characters.  Checks the
-        sizes of the strings to make sure the loop is as short as possible.
+        Used for testing if strings contain illegal characters, so string2
+        should be the (short) string of illegal characters, which is compiled
+        into a cached regular expression that scans string1 in one pass.
         '''
-        if len(string1) > len(string2):
-            string1, string2 = string2, string1
-        for char in string1:
-            if char in string2:
-                return True
-        return False
+        return charsearcher(string2)(string1) is not None
         
     def unixconfig(self):
         '''Handle forking, creating pid, getting the uid/gid, and chrooting'''
@@ -1248,6 +2880,7 @@ class DCHub(object):
         self.execafter.clear()
         self.wrappedfunctions.clear()
         self.replacedfunctions.clear()
+        self.commandfunctions.clear()
                 
     def wrapfunction(self, functionname, function, execbefore):
         '''Set new function to execute before/after hub function
@@ -1259,6 +2892,7 @@ class DCHub(object):
             oldfunction = getattr(self, functionname)
             self.wrappedfunctions[functionname] = oldfunction
             setattr(self, functionname, self._execwrapper(oldfunction))
+            self.commandfunctions.clear()
         place = self.execafter
         if execbefore:
             place = self.execbefore
@@ -1306,6 +2940,21 @@ class DCHub(object):
             return self.debugexception('Error writing %s file to disk' % type, self.loglevels['loadfileerror'])
         self.log.log(self.loglevels['loading'], 'Wrote %s file to disk' % type)
         
+    def zpipecompress(self, user):
+        '''Compress the start of user's outgoing data into a ZPipe block
+        
+        Called before each send, so only what is about to be sent is
+        compressed, a slice at a time.  The data before and after compressing
+        is counted in the zpipebytesin and zpipebytesout counters, and the
+        time spent in the zpipecompress histogram.
+        '''
+        start = time.time()
+        sizes = user.outgoing.compress(self.zpipelevel, self.zpipethreshold, self.zpipeslicesize)
+        if sizes is not None:
+            self.gethistogram('zpipecompress').add(time.time() - start)
+            self.counters['zpipebytesin'] += sizes[0]
+            self.counters['zpipebytesout'] += sizes[1]
+        
     ### Functions that handle commands sent by clients
     
     # There are four types of functions that handle commands sent by the user
@@ -1344,18 +2993,18 @@ class DCHub(object):
         # Checks recently submitted messages to see if this message pushes the
         # user over any of its limits
         curtime = time.time()
-        pretime = curtime - user.limits['timeperiod']
-        user.recentmessages = [messageinfo for messageinfo in user.recentmessages if messageinfo[0] > pretime]
-        nummessages = len(user.recentmessages)
+        recentmessages = user.recentmessages
+        recentmessages.expire(curtime - user.limits['timeperiod'])
+        nummessages = len(recentmessages)
         if nummessages >= user.limits['maxmessagespertimeperiod']:
             raise ValueError, 'too many messages within time period'
-        numchars = sum([messageinfo[1] for messageinfo in user.recentmessages]) + messagesize
+        numchars = recentmessages.totals[0] + messagesize
         if numchars >= user.limits['maxcharacterspertimeperiod']:
             raise ValueError, 'too many characters within time period'
-        numnewlines = sum([messageinfo[2] for messageinfo in user.recentmessages]) + numnl
+        numnewlines = recentmessages.totals[1] + numnl
         if numnewlines >= user.limits['maxnewlinespertimeperiod']:
             raise ValueError, 'too many newlines within time period'
-        user.recentmessages.append((curtime, messagesize, numnl, message))
+        recentmessages.add(curtime, messagesize, numnl, message)
             
     def got_ChatMessage(self, user, nick, message, *args):
         self.give_ChatMessage(user, message)
@@ -1489,6 +3138,21 @@ class DCHub(object):
     def badKick(self, user, args, parsedargs=None):
         pass
     
+    ## Metrics command - py-dchub extension
+    
+    def parseMetrics(self, user, args):
+        prefix = args
+        return (prefix,)
+        
+    def checkMetrics(self, user, prefix, *args):
+        pass
+        
+    def gotMetrics(self, user, prefix, *args):
+        self.giveMetrics(user, prefix)
+        
+    def badMetrics(self, user, args, parsedargs=None):
+        pass
+        
     ## MyINFO command
     
     def parseMyINFO(self, user, args):
@@ -1510,21 +3174,20 @@ class DCHub(object):
     def checkMyINFO(self, user, nick, description, tag, speed, speedclass, email, sharesize, *args):
         if nick != user.nick:
             raise ValueError, "nick doesn't match"
-        for char in description + tag + email + speed:
-            if char in self.badchars:
-                raise ValueError, 'bad character'
-        if speedclass not in range(1, 12):
+        search = charsearcher(self.badchars)
+        if search(description) or search(tag) or search(email) or search(speed):
+            raise ValueError, 'bad character'
+        if not 1 <= speedclass <= 11:
             raise ValueError, 'bad speedclass'
         if sharesize < user.limits['minsharesize']:
             raise ValueError, 'share size too low'
         # Check for too many recent MyINFOs
         curtime = time.time()
-        timelimit = curtime - user.limits['timeperiod']
-        user.myinfotimes = [myinfotime for myinfotime in user.myinfotimes if myinfotime > timelimit]
+        user.myinfotimes.expire(curtime - user.limits['timeperiod'])
         nummyinfos = len(user.myinfotimes)
         if nummyinfos >= user.limits['maxmyinfopertimeperiod']:
             raise ValueError, 'Too many MyINFOs with time period %s: %i' % (user.idstring, nummyinfos)
-        user.myinfotimes.append(curtime)
+        user.myinfotimes.add(curtime)
         
     def gotMyINFO(self, user, nick, description, tag, speed, speedclass, email, sharesize, *args):
         user.description    = description
@@ -1553,6 +3216,8 @@ class DCHub(object):
         if len(user.tag) > user.limits['maxtaglength']:
             tag = user.tag[:user.limits['maxtaglength'] - 1] + '>'
         user.myinfo = self.myinfoformat % (user.nick, user.description[:user.limits['maxdescriptionlength']], tag, user.speed, chr(user.speedclass), user.email[:user.limits['maxemaillength']], user.sharesize)
+        if self.users.get(user.nick) is user:
+            self.myinfos.add(user)
 
     ## MyPass command
     
@@ -1652,12 +3317,11 @@ class DCHub(object):
             raise ValueError, 'bad is minimum size'
         # Check for too many recent searches
         curtime = time.time()
-        timelimit = curtime - user.limits['timeperiod']
-        user.searchtimes = [searchtime for searchtime in user.searchtimes if searchtime > timelimit]
+        user.searchtimes.expire(curtime - user.limits['timeperiod'])
         numsearches = len(user.searchtimes)
         if numsearches >= user.limits['maxsearchespertimeperiod']:
             raise ValueError, 'Too many searches within time period'
-        user.searchtimes.append(curtime)
+        user.searchtimes.add(curtime)
         
     def gotSearch(self, user, host, sizerestricted, isminimumsize, size, datatype, searchpattern, *args):
         self.giveSearch(user, host, sizerestricted, isminimumsize, size, datatype, searchpattern)
@@ -1680,9 +3344,11 @@ class DCHub(object):
             filesize = int(filesize)
             freeslots = int(freeslots)
             totalslots = int(totalslots)
-        hubparts = parts[1].split(' ')
-        hubname = ' '.join(hubparts[:-1])
+        hubparts = parts[1].rsplit(' ', 1)
+        hubname = hubparts[0]
         hubhost = hubparts[-1]
+        if len(hubparts) == 1:
+            hubname = ''
         if hubhost[0] + hubhost[-1] != '()':
             raise ValueError, 'bad hubhost'
         hubhost = hubhost[1:-1]
@@ -1747,7 +3413,6 @@ class DCHub(object):
     
     def parseValidateNick(self, user, args):
         nick = args
-        print nick
         return (nick,)
         
     def checkValidateNick(self, user, nick, *args):
@@ -1770,7 +3435,6 @@ class DCHub(object):
     def gotValidateNick(self, user, nick, *args):
         user.nick = nick
         user.idstring += nick
-        print 'nick'
         if nick in self.accounts:
             if not self.accounts[nick]['password']:
                 return self.gotMyPass(user, '')
@@ -1794,10 +3458,30 @@ class DCHub(object):
         pass
     
     def gotFBAuthRand(self, user, randStr, *args):
+        fbConnIface, fbUid = self.validateFBToken(randStr)
+        self.finishFBAuth(user, fbConnIface, fbUid)
+        
+    def badFBAuthRand(self, user, args, parsedargs=None):
+        self.giveFBAuthError(user)
+        
+    def validateFBToken(self, randStr):
+        '''Return the FBConnectIface and Facebook uid for the token
+        
+        Returns (None, None) if the token isn't valid.  This accesses the 
+        database and Facebook, so it may block for a long time.
+        '''
         fbConnIface = FBConnectIface.FBConnectIface(randStr)
-        if fbConnIface.isValidToken() is True and fbConnIface.fetchUid() is not None:
-            user.validcommands  = set('ValidateNick Key'.split())
-            user.fbUid          = fbConnIface.fetchUid()
+        if fbConnIface.isValidToken() is True:
+            fbUid = fbConnIface.fetchUid()
+            if fbUid is not None:
+                return fbConnIface, fbUid
+        return None, None
+        
+    def finishFBAuth(self, user, fbConnIface, fbUid):
+        '''Continue the login if the token was valid, disconnect otherwise'''
+        if fbConnIface is not None:
+            user.validcommands  = set('Key Supports ValidateNick'.split())
+            user.fbUid          = fbUid
             user.fbConnIface    = fbConnIface
             self.giveLock(user)
             self.giveHubName(user)
@@ -1805,9 +3489,6 @@ class DCHub(object):
             user.validcommands = set(['FBAuthRand'])
             self.giveFBAuthError(user)
             
-    def badFBAuthRand(self, user, args, parsedargs=None):
-        self.giveFBAuthError(user)
-        
     ## Version command
     
     def parseVersion(self, user, args):
@@ -1831,20 +3512,19 @@ class DCHub(object):
             nick = user
         else:
             nick = user.nick
-        if self.handleslashme and (message.startswith('/me') or message.startswith('+me')):
-            message = '* %s%s|' % (nick, message[3:])
+        if self.handleslashme and message[:3] in ('/me', '+me'):
+            message = self.nmdcformats['MeMessage'] % (nick, message[3:])
         else:
-            message = '<%s> %s|' % (nick, message)
-        for user in self.users.itervalues():
-            user.sendmessage(message)
+            message = self.nmdcformats['ChatMessage'] % (nick, message)
+        self.broadcast(message)
             
     def give_EmptyCommand(self, user):
         '''Send an empty command to a user (as a keep alive)'''
-        user.sendmessage('|')
+        user.sendmessage(self.nmdcformats['EmptyCommand'])
         
     def give_HubFullRedirect(self, user):
         '''Give the user a redirect, and ignore the user afterwards'''
-        user.sendmessage('$ForceMove %s|' % self.hubredirectwhenfull)
+        user.sendmessage(self.nmdcformats['ForceMove'] % self.hubredirectwhenfull)
         user.ignoremessages = True
             
     def give_PrivateMessage(self, sender, receiver, message):
@@ -1859,37 +3539,36 @@ class DCHub(object):
         if hasattr(receiver, 'isDCHubBot') and not hasattr(sender, 'isDCHubBot') and not isinstance(sender, str):
             receiver.processcommand(sender, message)
         else:
-            if self.handleslashme and (message.startswith('/me') or message.startswith('+me')):
-                message = '* %s%s|' % (nick, message[3:])
+            if self.handleslashme and message[:3] in ('/me', '+me'):
+                message = self.nmdcformats['MeMessage'] % (nick, message[3:])
             else:
-                message = '<%s> %s|' % (nick, message)
-            receiver.sendmessage('$To: %s From: %s $%s|' % (receiver.nick, nick, message))            
+                message = self.nmdcformats['ChatMessage'] % (nick, message)
+            receiver.sendmessage(self.nmdcformats['PrivateMessage'] % (receiver.nick, nick, message))
             
     def give_SpamNotification(self, user, args):
         '''Give the user a spam/flood notification message'''
-        user.sendmessage('<Hub-Security> Your message was dropped because it violates our spam/flood limits.|')
+        user.sendmessage(self.nmdcformats['SpamNotification'])
         
     def give_WelcomeMessage(self, user):
         '''Give the user the welcome message for the hub'''
-        message = 'This hub is running version %s of py-dchub.\r\n%s' % (self.version, self.welcome)
-        user.sendmessage('<Hub-Security> %s|' % message)
+        user.sendmessage(self.getwelcomemessage())
         
     def giveBadPass(self, user):
         '''Give the user a message saying their password was incorrect'''
-        user.sendmessage('$BadPass|')
+        user.sendmessage(self.nmdcformats['BadPass'])
         
     def giveConnectToMe(self, sender, receiver, ip, port):
         '''Give receiver a connect to me message from sender'''
-        receiver.sendmessage('$ConnectToMe %s %s:%s|' % (receiver.nick, ip, port))
+        receiver.sendmessage(self.nmdcformats['ConnectToMe'] % (receiver.nick, ip, port))
         
     def giveForceMove(self, victim, user, where, message):
         '''Give victim a force move message'''
-        victim.sendmessage('$ForceMove %s|$To: %s From: %s $<%s> You are being redirected to %s because: %s|' % (where, victim.nick, user.nick, user.nick, where, message))
+        victim.sendmessage(self.nmdcformats['ForceMoveMessage'] % (where, victim.nick, user.nick, user.nick, where, message))
         victim.ignoremessages = True
         
     def giveGetPass(self, user):
         '''Ask the user for their password'''
-        user.sendmessage('$GetPass|')
+        user.sendmessage(self.nmdcformats['GetPass'])
     
     def giveHello(self, user, newuser=False):
         '''Give the user a hello message
@@ -1899,12 +3578,11 @@ class DCHub(object):
         If newuser is False, just gives the user a hello message (telling them 
         they have been logged in).
         '''
-        message = '$Hello %s|' % user.nick
+        message = self.nmdcformats['Hello'] % user.nick
         if newuser:
             ''' SSP: '''
-            for dcUser in self.users.iterkeys():
-                if user.fbConnIface.isFriend(self.users[ dcUser ].fbUid) is True and 'NoHello' not in self.users[ dcUser ].supports:
-                    self.users[ dcUser ].sendmessage(message)
+            self.broadcast(message, [client for client in self.users.itervalues()
+                if user.fbConnIface.isFriend(client.fbUid) is True and 'NoHello' not in client.supports])
             #for client in self.users.itervalues():
                 #if client is not user and 'NoHello' not in client.supports:
                     #client.sendmessage(message)
@@ -1913,29 +3591,28 @@ class DCHub(object):
             
     def giveHubIsFull(self, user):
         '''Give the user a message telling them the hub is full (ignore them after)'''
-        user.sendmessage('$HubIsFull|')
+        user.sendmessage(self.nmdcformats['HubIsFull'])
         user.ignoremessages = True
             
     def giveLogedIn(self, user):
         '''Give the user a message letting them know their password was accepted'''
-        user.sendmessage('$LogedIn %s|' % user.nick)
+        user.sendmessage(self.nmdcformats['LogedIn'] % user.nick)
             
     def giveLock(self, user):
         '''Give the user the lock'''
-        user.sendmessage('$Lock %s Pk=%s|' % (self.lockstring, self.privatekeystring))
+        user.sendmessage(self.nmdcformats['Lock'] % (self.lockstring, self.privatekeystring))
     
     ''' SSP: '''    
     def giveFBLoginURL(self, user):
         '''Give the user the Facebook Login URL'''
-        user.sendmessage('<Login URL> If not logged in, please login at %s to access this hub.|' % self.FBLoginURL)
-        user.sendmessage('$FBLogin %s|' % self.FBLoginURL)
+        user.sendmessage(self.nmdcformats['FBLogin'] % (self.FBLoginURL, self.FBLoginURL))
         user.validcommands = set(['FBAuthRand'])
         
     def giveFBAuthError(self, user):
         '''Give the error to the Client if Random Number authentication fails'''
-        print 'Error'
-        user.sendmessage('<Hub-Security> Access Denied.|')
-        user.sendmessage('$FBAuthError|')
+        if self.tracelevels['userloginerror']:
+            self.log.log(self.tracelevels['userloginerror'], 'Facebook authentication failed: %s' % user.idstring)
+        user.sendmessage(self.nmdcformats['FBAuthError'])
         user.validcommands  = set(['FBLogin FBAuthRand'])
         self.removeuser(user)
         
@@ -1945,44 +3622,42 @@ class DCHub(object):
         If user is None, the hub name has changed, so send it to all users
         Otherwise, the user has just logged in, so send it just to it
         '''
-        message = '$HubName %s|' % self.name
+        message = self.nmdcformats['HubName'] % self.name
         if user is None:
-            for user in self.users.itervalues():
-                user.sendmessage(message)
+            self.broadcast(message)
         else:
             user.sendmessage(message)
             
+    def giveMetrics(self, user, prefix=''):
+        '''Give the user the hub's metrics whose names start with prefix
+        
+        Counters and gauges are given as name and value, and histograms as
+        name, count, and the 50th, 95th, and 99th percentiles and maximum in
+        seconds.
+        '''
+        values, histograms = self.getmetrics()
+        lines = ['%s %s' % (name, value) for name, value in sorted(values.items()) if name.startswith(prefix)]
+        for name, histogram in sorted(histograms.items()):
+            if histogram.count and name.startswith(prefix):
+                lines.append('%s count=%i p50=%.6f p95=%.6f p99=%.6f max=%.6f' % tuple([name, 
+                  histogram.count] + histogram.percentiles([50, 95, 99]) + [histogram.max]))
+        user.sendmessage(self.nmdcformats['HubSecurityMessage'] % '\r\n'.join(['Hub metrics:'] + lines))
+        
     def giveMyINFO(self, client, newuser=False):
         '''Give MyINFO for user to the hub
         
         If newuser is True, give that user the MyINFO for everyuser in the hub
+        (from self.myinfos)
         '''
         if newuser:
-            message = []
-            ''' SSP: '''
-            for dcUser in self.users.iterkeys():
-                if client.fbConnIface.isFriend(self.users[ dcUser ].fbUid) is True:
-                    message.append(dcUser.myinfo)
-                
-            #for user in self.users.itervalues():
-             #   message.append(user.myinfo)
-            message = ''.join(message)
-            client.sendmessage(message)
-        myinfo = client.myinfo
+            client.sendframes(self.getmyinfos(client), time.time())
         ''' SSP: '''
-        for dcUser in self.users.iterkeys():
-            if client.fbConnIface.isFriend(self.users[ dcUser ].fbUid) is True:
-                self.users[ dcUser ].sendmessage(myinfo)
+        self.broadcast(client.myinfo, [user for user in self.users.itervalues()
+            if client.fbConnIface.isFriend(user.fbUid) is True])
             
     def giveNickList(self, user):
         '''Give the nick list to the user'''
-        ''' SSP: '''
-        friendList  = []
-        for dcUser in self.users.iterkeys():
-            if user.fbConnIface.isFriend(self.users[ dcUser ].fbUid) is True or dcUser == user.nick:
-                friendList.append(dcUser)
-                
-        user.sendmessage('$NickList %s$$|' % '$$'.join(friendList))
+        user.sendmessage(self.getnicklist(user))
             
     def giveOpList(self, user=None):
         '''Give the op list to a user or the all users
@@ -1990,39 +3665,31 @@ class DCHub(object):
         If user is None, the op list has changed, so give it to all users
         Otherwise, the user has just logged in, so give them the op list
         '''
-        if self.ops:
-            message = '$OpList %s$$|' % '$$'.join(self.ops.keys())
-        else:
-            message = '$OpList |'
+        message = self.getlistmessage('OpList')
         if user is None:
-            for user in self.users.itervalues():
-                user.sendmessage(message)
+            self.broadcast(message)
         else:
             user.sendmessage(message)
             
     def giveQuit(self, user):
         '''Give hub a message that the user has disconnected'''
-        message = '$Quit %s|' % user.nick
-        for client in self.users.itervalues():
-            client.sendmessage(message)
+        self.broadcast(self.nmdcformats['Quit'] % user.nick)
 
     def giveRevConnectToMe(self, sender, receiver):
         '''Give RevConnectToMe to sender from receiver'''
-        receiver.sendmessage('$RevConnectToMe %s %s|' % (sender.nick, receiver.nick))
+        receiver.sendmessage(self.nmdcformats['RevConnectToMe'] % (sender.nick, receiver.nick))
 
     def giveSearch(self, searcher, host, sizerestricted, isminimumsize, size, datatype, searchpattern):
         '''Give search message from searcher to the entire hub'''
-        message = '$Search %s %s?%s?%s?%s?%s|' % (host, sizerestricted, isminimumsize, size, datatype, searchpattern)
-        for user in self.users.itervalues():
-            user.sendmessage(message)
+        self.broadcast(self.nmdcformats['Search'] % (host, sizerestricted, isminimumsize, size, datatype, searchpattern))
             
     def giveSR(self, searcher, resulter, path, filesize, freeslots, totalslots, hubname, hubhost):
         '''Give search response from resulter to searcher'''
-        searcher.sendmessage('$SR %s %s\x05%i %i/%i\x05%s (%s)|' % (resulter.nick, path, filesize, freeslots, totalslots, hubname, hubhost))
+        searcher.sendmessage(self.nmdcformats['SR'] % (resulter.nick, path, filesize, freeslots, totalslots, hubname, hubhost))
         
     def giveSupports(self, user):
         '''Give user a list of extensions that the server supports'''
-        user.sendmessage('$Supports %s|' % ' '.join(self.supports))
+        user.sendmessage(self.nmdcformats['Supports'] % ' '.join(self.supports))
         
     def giveUserCommand(self, user=None, command=None):
         '''Give user command(s) to user or hub
@@ -2060,18 +3727,16 @@ class DCHub(object):
         If requestor is None, give all ops the requestee's IP
         '''
         if requestor is not None and requestee is not None:
-            requestor.sendmessage('$UserIP %s %s|' % (requestee.nick, requestee.ip))
+            requestor.sendmessage(self.nmdcformats['UserIP'] % (requestee.nick, requestee.ip))
         elif requestor is not None:
-            requestor.sendmessage('$UserIP %s$$|' % '$$'.join(['%s %s' % (user.nick, user.ip) for user in self.users.itervalues()]))
+            requestor.sendmessage(self.getlistmessage('UserIPList'))
         elif requestee is not None:
-            message = '$UserIP %s %s|' % (requestee.nick, requestee.ip)
-            for op in self.ops.itervalues():
-                if 'UserIP2' in op.supports:
-                    op.sendmessage(message)
+            message = self.nmdcformats['UserIP'] % (requestee.nick, requestee.ip)
+            self.broadcast(message, [op for op in self.ops.itervalues() if 'UserIP2' in op.supports])
 
     def giveValidateDenide(self, user):
         '''Give a user a message that their login has been denied'''
-        user.sendmessage('$ValidateDenide|')
+        user.sendmessage(self.nmdcformats['ValidateDenide'])
         
 def parseargs():
     '''Parses keyword arguments given on the command line'''
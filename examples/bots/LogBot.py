@@ -3,39 +3,59 @@ import traceback
 import logging
 import DCHub
 
-class DCClientLogHandler(logging.Handler):
-    '''Logging handler that sends log messages to a Direct Connect client'''
-    def __init__(self, user, bot):
-        logging.Handler.__init__(self)
+class DCClientLogHandler(DCHub.QueueLogHandler):
+    '''Logging handler that sends log messages to a Direct Connect client
+    
+    Log messages are queued, and sent by the bot from the hub's main loop, 
+    at most maxmessages per round, so logging never sends messages to users
+    from inside other hub functions, and a flood of log messages is dropped
+    instead of flooding the op.  This doesn't use the hub's
+    BackgroundLogHandler, since its writer thread would send the messages
+    while the main loop is changing the same outgoing buffers.
+    '''
+    def __init__(self, user, bot, maxsize=1000):
+        DCHub.QueueLogHandler.__init__(self, maxsize)
         self.escapetranstable = (('\n', '\r\n'), ('|', '&#124;'), ('$', '&#36;'))
         self.user = user
         self.bot = bot
         
     def emit(self, record):
-        '''Send user the log message via a private message from the bot
+        '''Queue the log message to be sent to the user
         
         Note that log messages for data sent that include private messages from
         the bot are not sent to the user, as this would allow for an infinite
         loop.  If multiple commands were sent to the user, and even one is a 
         private message from the bot, the user will not get a related log 
         message.
-        
-        Also note that the user will not be sent tracebacks if the the message
-        is logged using exception.
         '''
-        message = self.format(record)
         # Note that if the log level for data sent messages is changed from
         # the default of 1, you could get an infinite loop unless you change
         # the value here
-        if record.levelno == 1 and message.find('From: %s $<%s>' % (self.bot.nick, self.bot.nick)) != -1:
+        if record.levelno == 1 and record.getMessage().find('From: %s $<%s>' % (self.bot.nick, self.bot.nick)) != -1:
             # Ignore data sent messages that include private messages from the
             # bot
             return
-        # Escape illegal characters
-        for changethis, tothis in self.escapetranstable:
-            message = message.replace(changethis, tothis)
-        self.user.sendmessage("$To: %s From: %s $<%s> %s: %s|" % (self.user.nick, 
-          self.bot.nick, self.bot.nick, record.levelname, message))
+        DCHub.QueueLogHandler.emit(self, record)
+        
+    def send(self, maxmessages):
+        '''Send user up to maxmessages queued log messages via private 
+        messages from the bot
+        
+        Note that the user will not be sent tracebacks if the the message
+        is logged using exception.
+        '''
+        for record in self.getrecords(maxmessages):
+            if record.exc_text:
+                # Other handlers share the record, so leave it unchanged
+                record = logging.makeLogRecord(record.__dict__)
+                record.exc_text = None
+            message = self.format(record)
+            # Escape illegal characters
+            for changethis, tothis in self.escapetranstable:
+                message = message.replace(changethis, tothis)
+            self.user.sendmessage("$To: %s From: %s $<%s> %s: %s|" % (self.user.nick, 
+              self.bot.nick, self.bot.nick, record.levelname, message))
+            self.queue.task_done()
 
 class LogBot(DCHub.DCHubBot):
     '''Remote logging bot, allowing ops to register and receive log messages
@@ -50,12 +70,17 @@ class LogBot(DCHub.DCHubBot):
     The bot closes all log handlers it has opened when it is reloaded, so after
     reloading the bots, ops that want to continue to receive logging messages
     should resend the start command.
+    
+    Log messages are sent after the hub processes commands, at most 
+    maxmessages to each op per round.
     '''
     
     def __init__(self, hub, nick = 'LogBot'):
         DCHub.DCHubBot.__init__(self, hub, nick)
         self.handlers = {}
+        self.maxmessages = 10
         self.execbefore['removeuser'] = self.removeloghandler
+        self.execafter['processcommands'] = self.sendlogmessages
                 
     def close(self):
         '''Close all handlers that the bot has opened'''
@@ -93,6 +118,12 @@ class LogBot(DCHub.DCHubBot):
             self.hub.log.removeHandler(self.handlers[user.nick])
             del self.handlers[user.nick]
             
+    def sendlogmessages(self, returnobj):
+        '''Send ops the log messages queued since the last round'''
+        for handler in self.handlers.values():
+            handler.send(self.maxmessages)
+        return returnobj
+            
     def setlevel(self, user, level):
         '''Change the verbosity of the log messages sent to a user'''
         if user.nick in self.handlers and user.loggedin:
@@ -143,6 +143,7 @@ class AdvancedDCHub(ThreadedDCHub):
         '''
         curtime = int(time())
         self.eventtypedict[eventtypeid][entry] = until
+        self.timers.schedule(('event', eventtypeid, entry), until, 'expireevent', eventtypeid, entry)
         query = 'INSERT INTO activeevents (eventtypeid, entry, until) VALUES (%i, %s, %i);' % (eventtypeid, dbquote(entry), until)
         self.addtask(self.execsql, query)
         noteby, accountid = self.getoid(op), self.getoid(user)
@@ -462,6 +463,17 @@ class AdvancedDCHub(ThreadedDCHub):
                 raise error
         return rows
     
+    def expireconnectcheck(self, receiver, op):
+        '''Forget an op's reverse connection request once it has run out'''
+        if self.connectchecks.get((receiver, op), 0) <= int(time()):
+            self.connectchecks.pop((receiver, op), None)
+            
+    def expireevent(self, eventtypeid, entry):
+        '''Remove the event (punishment) once it has run out'''
+        until = self.eventtypedict[eventtypeid].get(entry)
+        if until is not None and until <= int(time()):
+            self.removeevent(entry, None, None, eventtypeid)
+        
     def formattime(self, seconds):
         '''Return the formated time for the given unix ticks'''
         return strftime(self.historyftime, gmtime(seconds))
@@ -582,6 +594,9 @@ class AdvancedDCHub(ThreadedDCHub):
                 eventtypes[eventtypeid][entry] = until
         except:
             return self.debugexception('Error loading punishments', self.loglevels['loadfileerror'])
+        for eventtypeid, events in eventtypes.iteritems():
+            for entry, until in events.iteritems():
+                self.timers.schedule(('event', eventtypeid, entry), until, 'expireevent', eventtypeid, entry)
         self.bans.clear()
         self.bans.update(bans)
         self.silences.clear()
@@ -653,6 +668,7 @@ class AdvancedDCHub(ThreadedDCHub):
             elif nick in self.ops:
                 del self.ops[nick]
                 user.validcommands -= self.validopcommands
+            self.listmessages.clear()
             self.giveOpList()
             
     def nicksearch(self, user, nick):
@@ -673,6 +689,7 @@ class AdvancedDCHub(ThreadedDCHub):
         '''
         if entry in self.eventtypedict[eventtypeid]:
             del self.eventtypedict[eventtypeid][entry]
+        self.timers.cancel(('event', eventtypeid, entry))
         query = 'DELETE FROM activeevents WHERE eventtypeid = %i AND entry = %s;' % (eventtypeid, dbquote(entry))
         self.addtask(self.execsql, query)
         noteby, accountid = self.getoid(op), self.getoid(user)
@@ -798,7 +815,7 @@ class AdvancedDCHub(ThreadedDCHub):
         # Unverified users can only use the following commands
         self.validusercommands = set('''_ChatMessage _PrivateMessage MyINFO GetINFO
             GetNickList ConnectToMe UserIP'''.split())
-        self.validopcommands = set('OpForceMove Kick Close ReloadBots'.split())
+        self.validopcommands = set('OpForceMove Kick Close ReloadBots Metrics'.split())
         # Verified users can use these commands as well
         self.verifiedusercommands = set('Search SR RevConnectToMe'.split())
         if not self.restrictunverifiedusers:
@@ -844,6 +861,7 @@ class AdvancedDCHub(ThreadedDCHub):
         '''Update an event (punishment) to make it for a longer or shorter time'''
         curtime = int(time())
         self.eventtypedict[eventtypeid][entry] = until
+        self.timers.schedule(('event', eventtypeid, entry), until, 'expireevent', eventtypeid, entry)
         query = 'UPDATE activeevents SET until = %i WHERE eventtypeid = %i AND entry = %s;' % (until, eventtypeid, dbquote(entry))
         self.addtask(self.execsql, query)
         noteby, accountid = self.getoid(op), self.getoid(user)
@@ -958,23 +976,19 @@ class AdvancedDCHub(ThreadedDCHub):
         curtime = int(time())
         if self.restrictunverifiedusers and not (hasattr(receiver, 'verified') and receiver.verified):
             if user.op:
-                for key, value in self.connectchecks.items():
-                    if value <= curtime:
-                        del self.connectchecks[key]
                 self.connectchecks[(receiver, user)] = curtime + self.connectchecktime
+                self.timers.schedule(('connectcheck', receiver, user), curtime + self.connectchecktime, 'expireconnectcheck', receiver, user)
             else:
                 raise ValueError, 'Non ops not allowed to connect to unverified users'
 
     def giveSearch(self, searcher, host, sizerestricted, isminimumsize, size, datatype, searchpattern):
         '''Give search message from searcher to all verified users'''
-        message = '$Search %s %s?%s?%s?%s?%s|' % (host, sizerestricted, isminimumsize, size, datatype, searchpattern)
+        message = self.nmdcformats['Search'] % (host, sizerestricted, isminimumsize, size, datatype, searchpattern)
         if self.restrictunverifiedusers:
-            for user in self.users.itervalues():
-                if (hasattr(user, 'verified') and user.verified):
-                    user.sendmessage(message)
+            self.broadcast(message, [user for user in self.users.itervalues()
+                if (hasattr(user, 'verified') and user.verified)])
         else:
-            for user in self.users.itervalues():
-                user.sendmessage(message)
+            self.broadcast(message)
 
     def checkValidateNick(self, user, nick, *args):
         '''Check that the user isn't banned'''
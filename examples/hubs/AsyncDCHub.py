@@ -0,0 +1,162 @@
+from DCHub import DCHub, run
+from collections import deque
+import fcntl
+import os
+import sys
+import threading
+from Queue import Queue
+
+class BlockingCall(object):
+    '''Call that may block, yielded by coroutines run by AsyncDCHub'''
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+def worker(tasks, completions, wakeupwriter):
+    '''Run blocking calls, and hand their results back to the main loop
+
+    This doesn't reference the hub itself, so workers keep running correctly
+    when the hub is reloaded.
+    '''
+    while True:
+        task = tasks.get(block=True)
+        if task is None:
+            break
+        coroutine, call = task
+        try:
+            result = (True, call.function(*call.args, **call.kwargs))
+        except:
+            result = (False, sys.exc_info())
+        completions.append((coroutine, result))
+        try:
+            os.write(wakeupwriter, 'x')
+        except OSError:
+            # The pipe is full, so the main loop is going to wake up anyway
+            pass
+
+def setnonblocking(fd):
+    '''Make reads and writes on a file descriptor non-blocking'''
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+class AsyncDCHub(DCHub):
+    '''Hub that can wait for blocking work without blocking the main loop
+
+    ThreadedDCHub runs blocking tasks in threads that change the hub while
+    the main loop is running, so everything has to be done while holding the
+    hub's lock.  This hub runs only the blocking call itself in a worker
+    thread, and continues the rest of the work on the main loop once the call
+    has finished, so the parse*/check*/got*/bad*/give* functions and bots
+    work exactly as they do in DCHub, without any locking.
+
+    Work that needs to wait for blocking calls is written as a generator
+    (coroutine) that yields the blocking calls, and receives their return
+    values (or has their exceptions raised) where it yields:
+
+        def givehostname(self, requester, user):
+            try:
+                hostname = yield self.blocking(socket.gethostbyaddr, user.ip)
+            except socket.error:
+                hostname = ('unknown',)
+            requester.sendmessage('<Hub-Security> %s|' % hostname[0])
+
+    and is started with spawn:
+
+        self.spawn(self.givehostname(requester, user))
+
+    The hub itself uses this for validating Facebook tokens, which accesses
+    the database and Facebook.  Keep in mind that users may have left the hub
+    by the time a blocking call returns.
+
+    The blocking calls are run by a pool of worker threads, by default 5.  To
+    change the number of threads, add numworkers as a keyword argument when
+    instantiating the hub (or to the configuration file).  Worker threads
+    wake up the main loop through a pipe, so this hub only runs on Unix.
+    '''
+    def blocking(self, function, *args, **kwargs):
+        '''Return a blocking call for a coroutine to yield'''
+        return BlockingCall(function, args, kwargs)
+
+    def cleanup(self):
+        '''Stop the worker threads unless the hub is being reloaded'''
+        self.supers['AsyncDCHub'].cleanup()
+        if not self.reloadonexit:
+            for thread in self.workers:
+                self.tasks.put(None)
+            del self.workers[:]
+
+    def gotFBAuthRand(self, user, randStr, *args):
+        '''Validate the token in a worker thread'''
+        # Don't accept any commands until the token has been validated
+        user.validcommands = set()
+        self.spawn(self.validateFBTokenAsync(user, randStr))
+
+    def handlecompletions(self):
+        '''Resume coroutines whose blocking calls have finished'''
+        try:
+            while os.read(self.wakeupreader, 4096):
+                pass
+        except OSError:
+            pass
+        completions = self.completions
+        while completions:
+            coroutine, (ok, value) = completions.popleft()
+            self.resume(coroutine, ok, value)
+
+    def handlereadsockets(self, readsockets):
+        '''Handle the wake up pipe before the sockets'''
+        if self.wakeupreader in readsockets:
+            readsockets = [id for id in readsockets if id != self.wakeupreader]
+            self.handlecompletions()
+        self.supers['AsyncDCHub'].handlereadsockets(readsockets)
+
+    def resume(self, coroutine, ok=True, value=None):
+        '''Run coroutine until it yields another blocking call or finishes'''
+        try:
+            if ok:
+                call = coroutine.send(value)
+            else:
+                call = coroutine.throw(*value)
+        except StopIteration:
+            return
+        except:
+            return self.log.exception('Error in coroutine %r' % coroutine)
+        while len(self.workers) < self.numworkers:
+            thread = threading.Thread(target=worker, args=(self.tasks, self.completions, self.wakeupwriter))
+            thread.setDaemon(1)
+            thread.start()
+            self.workers.append(thread)
+        self.tasks.put((coroutine, call))
+
+    def setupdefaults(self, **kwargs):
+        '''Setup coroutine related defaults'''
+        super(AsyncDCHub, self).setupdefaults(**kwargs)
+        self.supers['AsyncDCHub'] = super(AsyncDCHub, self)
+        self.reloadmodules.append('AsyncDCHub')
+        self.numworkers = 5
+        self.workers = []
+        self.tasks = Queue(0)
+        self.completions = deque()
+        self.wakeupreader, self.wakeupwriter = None, None
+
+    def setuppoller(self):
+        '''Create the pipe used by the worker threads to wake up the main loop'''
+        self.supers['AsyncDCHub'].setuppoller()
+        if self.wakeupreader is None:
+            self.wakeupreader, self.wakeupwriter = os.pipe()
+            setnonblocking(self.wakeupreader)
+            setnonblocking(self.wakeupwriter)
+        self.poller.register(self.wakeupreader)
+
+    def spawn(self, coroutine):
+        '''Start running a coroutine on the main loop'''
+        self.resume(coroutine)
+
+    def validateFBTokenAsync(self, user, randStr):
+        '''Coroutine validating the Facebook token without blocking the hub'''
+        fbConnIface, fbUid = yield self.blocking(self.validateFBToken, randStr)
+        if self.sockets.get(user.socketid) is user:
+            self.finishFBAuth(user, fbConnIface, fbUid)
+
+if __name__ == '__main__':
+    run(AsyncDCHub)
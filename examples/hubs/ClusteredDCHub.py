@@ -0,0 +1,399 @@
+import marshal
+import os
+import socket
+import struct
+from DCHub import DCHub, DCHubUser, OutgoingBuffer, blockingerrors, run
+
+# Value of SO_REUSEPORT under Linux, the socket module doesn't define it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+class PeerLink(object):
+    '''Connection to another worker process of the cluster
+
+    Messages are tuples, serialized with marshal and prefixed with their
+    length.  The first item of the tuple is the message type.
+    '''
+    def __init__(self, workerid, sock):
+        self.workerid = workerid
+        self.socket = sock
+        self.socketid = sock.fileno()
+        self.incoming = ''
+        self.outgoing = OutgoingBuffer()
+        self.poller = None
+        sock.setblocking(0)
+
+    def close(self):
+        '''Close related socket connection'''
+        self.socket.close()
+
+    def recv(self):
+        '''Read data from the socket and return the completed messages
+
+        Raises EOFError if the other worker has closed the connection.
+        '''
+        data = self.socket.recv(65536)
+        if not data:
+            raise EOFError, 'worker %s closed the connection' % self.workerid
+        data = self.incoming + data
+        messages = []
+        start, datalen = 0, len(data)
+        while datalen - start >= 4:
+            size = struct.unpack('!I', data[start:start + 4])[0]
+            if datalen - start - 4 < size:
+                break
+            messages.append(marshal.loads(data[start + 4:start + 4 + size]))
+            start += 4 + size
+        self.incoming = data[start:]
+        return messages
+
+    def send(self, *message):
+        '''Place a message in the outgoing buffer for the other worker'''
+        payload = marshal.dumps(message)
+        if not self.outgoing.size and self.poller is not None:
+            self.poller.modify(self.socketid, True)
+        self.outgoing.append(struct.pack('!I', len(payload)) + payload)
+
+class DCHubRemoteUser(DCHubUser):
+    '''User logged in to another worker process of the cluster
+
+    Messages sent to the user are forwarded to the worker the user is
+    connected to, as are requests to ignore or remove the user.
+    '''
+    isremote = True
+
+    def __init__(self, link, nick, ip, myinfo, op, supports, fbUid):
+        DCHubUser.__init__(self)
+        self.link = link
+        self.nick = nick
+        self.ip = ip
+        self.myinfo = myinfo
+        self.op = op
+        self.supports = list(supports)
+        self.fbUid = fbUid
+        self.loggedin = True
+        self.idstring = 'worker%s/%s' % (link.workerid, nick)
+
+    def getignoremessages(self):
+        return self._ignoremessages
+
+    def setignoremessages(self, ignoremessages):
+        '''Have the worker the user is connected to ignore the user'''
+        self._ignoremessages = ignoremessages
+        if ignoremessages:
+            self.link.send('ignore', self.nick)
+
+    ignoremessages = property(getignoremessages, setignoremessages)
+
+    def sendmessage(self, message):
+        '''Forward the message to the worker the user is connected to'''
+        self.link.send('send', self.nick, message)
+
+class ClusteredDCHub(DCHub):
+    '''Hub running as several worker processes, appearing as a single hub
+
+    A single hub process can only use one processor core.  This hub forks
+    clusterworkers worker processes (by default one per core) after loading
+    its configuration, and each worker accepts connections on the same ports
+    using SO_REUSEPORT, so the operating system spreads the connections
+    between them.  This needs a Linux kernel of 3.9 or later.
+
+    Every pair of workers is connected by a Unix domain socket.  When a user
+    logs in, changes their MyINFO, or leaves, the worker the user is connected
+    to tells the other workers, so every worker has a directory of all users
+    in the hub (nick, IP, MyINFO, op status and owning worker).  Users on
+    other workers are represented by DCHubRemoteUser objects in self.users,
+    so the parse*/check*/got*/give* functions work unchanged: messages sent to
+    a remote user ($To:, $ConnectToMe, $SR, etc.) are forwarded to the
+    worker the user is connected to, and a broadcast to the whole hub is sent
+    once to each other worker, which gives it to its own users.
+
+    Each worker loads its own bots, and bots aren't shared between workers.
+    Signals received by the first worker are passed on to the others.
+    '''
+    def broadcast(self, message, users=None):
+        '''Give the message to local users, and once to each other worker'''
+        if users is not None:
+            return self.supers['ClusteredDCHub'].broadcast(message, users)
+        self.supers['ClusteredDCHub'].broadcast(message, self.localusers())
+        for link in self.peers.itervalues():
+            link.send('broadcast', message)
+
+    def cleanup(self):
+        '''Stop the other workers if this is the first worker'''
+        self.supers['ClusteredDCHub'].cleanup()
+        if not self.reloadonexit:
+            for link in self.peers.values():
+                self.removepeer(link, quiet=True)
+
+    def createlisteningsocket(self, ip, port):
+        '''Create a listening socket that other workers can also bind to'''
+        listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listensock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        listensock.bind((ip, port))
+        listensock.listen(self.listenbacklog)
+        listensock.setblocking(0)
+        self.listensocks[listensock.fileno()] = listensock
+        self.poller.register(listensock.fileno())
+
+    def createmetricssocket(self):
+        '''Only listen for metrics requests in the first worker
+
+        The workers can't all bind the metrics port, and a scraper should see
+        the counters of the same worker every time.
+        '''
+        if not self.workerid:
+            self.supers['ClusteredDCHub'].createmetricssocket()
+
+    def forkworkers(self):
+        '''Fork the worker processes, and connect every pair of workers
+
+        The current process becomes worker 0.
+        '''
+        numworkers = self.clusterworkers
+        if numworkers < 1:
+            try:
+                import multiprocessing
+                numworkers = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                numworkers = 1
+        pairs = {}
+        for i in range(numworkers):
+            for j in range(i + 1, numworkers):
+                pairs[(i, j)] = socket.socketpair()
+        self.workerid = 0
+        for workerid in range(1, numworkers):
+            pid = os.fork()
+            if pid == 0:
+                self.workerid = workerid
+                self.childpids = []
+                break
+            self.childpids.append(pid)
+        for (i, j), (sock1, sock2) in pairs.items():
+            if i == self.workerid:
+                link = PeerLink(j, sock1)
+                sock2.close()
+            elif j == self.workerid:
+                link = PeerLink(i, sock2)
+                sock1.close()
+            else:
+                sock1.close()
+                sock2.close()
+                continue
+            self.peers[link.workerid] = link
+            self.peersockets[link.socketid] = link
+        self.log.log(self.loglevels['hubstatus'], 'Worker %i of %i started, pid %i' % (self.workerid, numworkers, os.getpid()))
+
+    def giveQuit(self, user):
+        '''Give the quit of a user on another worker only to local users
+
+        Other workers are told about quits by the user's own worker, or find
+        out themselves if that worker died.
+        '''
+        if hasattr(user, 'isremote'):
+            return self.supers['ClusteredDCHub'].broadcast(self.nmdcformats['Quit'] % user.nick, self.localusers())
+        self.supers['ClusteredDCHub'].giveQuit(user)
+
+    def gotMyINFO(self, user, nick, description, tag, speed, speedclass, email, sharesize, *args):
+        '''Tell the other workers about changes to a logged in user's MyINFO'''
+        loggedin = user.loggedin
+        self.supers['ClusteredDCHub'].gotMyINFO(user, nick, description, tag, speed, speedclass, email, sharesize, *args)
+        if loggedin and user.loggedin:
+            for link in self.peers.itervalues():
+                link.send('myinfo', user.nick, user.myinfo)
+
+    def handleerrorsockets(self, errorsockets):
+        '''Drop the connection to workers whose sockets are in error state'''
+        usersockets = []
+        for id in errorsockets:
+            if id in self.peersockets:
+                self.removepeer(self.peersockets[id])
+            else:
+                usersockets.append(id)
+        self.supers['ClusteredDCHub'].handleerrorsockets(usersockets)
+
+    def handlepeer(self, link):
+        '''Read and process messages from another worker'''
+        try:
+            messages = link.recv()
+        except socket.error, error:
+            if error.args[0] not in blockingerrors:
+                self.removepeer(link)
+            return
+        except EOFError:
+            return self.removepeer(link)
+        for message in messages:
+            try:
+                getattr(self, 'peer%s' % message[0])(link, *message[1:])
+            except:
+                self.log.exception('Error processing message from worker %s: %r' % (link.workerid, message))
+
+    def handlereadsockets(self, readsockets):
+        '''Handle messages from other workers before the sockets'''
+        if self.peersockets:
+            otherids = []
+            for id in readsockets:
+                if id in self.peersockets:
+                    self.handlepeer(self.peersockets[id])
+                else:
+                    otherids.append(id)
+            readsockets = otherids
+        self.supers['ClusteredDCHub'].handlereadsockets(readsockets)
+
+    def handlewritesockets(self, writesockets):
+        '''Send queued messages to other workers before the sockets'''
+        if self.peersockets:
+            otherids = []
+            for id in writesockets:
+                if id not in self.peersockets:
+                    otherids.append(id)
+                    continue
+                link = self.peersockets[id]
+                if not link.outgoing:
+                    self.poller.modify(id, False)
+                    continue
+                try:
+                    link.outgoing.consume(link.socket.send(link.outgoing.nextchunk()))
+                except socket.error, error:
+                    if error.args[0] not in blockingerrors:
+                        self.removepeer(link)
+                    continue
+                if not link.outgoing:
+                    self.poller.modify(id, False)
+            writesockets = otherids
+        self.supers['ClusteredDCHub'].handlewritesockets(writesockets)
+
+    def localusers(self):
+        '''Iterate over the logged in users connected to this worker'''
+        for user in self.users.itervalues():
+            if not hasattr(user, 'isremote'):
+                yield user
+
+    def loginuser(self, user):
+        '''Tell the other workers about the user'''
+        self.supers['ClusteredDCHub'].loginuser(user)
+        for link in self.peers.itervalues():
+            link.send('login', user.nick, user.ip, user.myinfo, user.op,
+              tuple(user.supports), getattr(user, 'fbUid', None))
+
+    def removepeer(self, link, quiet=False):
+        '''Drop the connection to another worker, and remove its users
+
+        Local users are told that the removed users quit.
+        '''
+        if not quiet:
+            self.log.error('Lost connection to worker %s' % link.workerid)
+        self.poller.unregister(link.socketid)
+        link.close()
+        del self.peers[link.workerid]
+        del self.peersockets[link.socketid]
+        for user in self.users.values():
+            if getattr(user, 'link', None) is link:
+                self.peerlogout(link, user.nick)
+                self.giveQuit(user)
+        return True
+
+    def removeuser(self, user):
+        '''Tell the other workers a user left, or ask them to remove their user
+
+        Remote users are removed when the worker they are connected to says
+        they left.
+        '''
+        if hasattr(user, 'isremote'):
+            if self.users.get(user.nick) is user:
+                user.link.send('remove', user.nick)
+            return
+        loggedin = getattr(user, 'loggedin', False) and self.users.get(user.nick) is user
+        self.supers['ClusteredDCHub'].removeuser(user)
+        if loggedin:
+            for link in self.peers.itervalues():
+                link.send('logout', user.nick)
+
+    def setupdefaults(self, **kwargs):
+        '''Setup cluster related defaults'''
+        super(ClusteredDCHub, self).setupdefaults(**kwargs)
+        self.supers['ClusteredDCHub'] = super(ClusteredDCHub, self)
+        self.reloadmodules.append('ClusteredDCHub')
+        # Number of worker processes, 0 for one per processor core
+        self.clusterworkers = 0
+        self.workerid = None
+        self.childpids = []
+        self.peers, self.peersockets = {}, {}
+
+    def setuppoller(self):
+        '''Start the workers first, so each has its own poller'''
+        if self.workerid is None:
+            self.forkworkers()
+        self.supers['ClusteredDCHub'].setuppoller()
+        for link in self.peers.itervalues():
+            link.poller = self.poller
+            self.poller.register(link.socketid, bool(link.outgoing))
+
+    def sighandler(self, signum, frame):
+        '''Stop the other workers as well'''
+        for pid in self.childpids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+        self.supers['ClusteredDCHub'].sighandler(signum, frame)
+
+    def sighuphandler(self, signum, frame):
+        '''Reload the other workers as well'''
+        for pid in self.childpids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+        self.supers['ClusteredDCHub'].sighuphandler(signum, frame)
+
+    ### Messages from other workers
+
+    def peerbroadcast(self, link, message):
+        self.supers['ClusteredDCHub'].broadcast(message, self.localusers())
+
+    def peerignore(self, link, nick):
+        user = self.nicks.get(nick)
+        if user is not None and not hasattr(user, 'isremote'):
+            user.ignoremessages = True
+
+    def peerlogin(self, link, nick, ip, myinfo, op, supports, fbUid):
+        if nick in self.nicks:
+            return self.log.log(self.loglevels['duplicatelogin'], 'Worker %s logged in %s, which is already in use' % (link.workerid, nick))
+        user = DCHubRemoteUser(link, nick, ip, myinfo, op, supports, fbUid)
+        self.setuplimits(user)
+        self.nicks[nick] = self.users[nick] = user
+        self.myinfos.add(user)
+        self.listmessages.clear()
+        if op:
+            self.ops[nick] = user
+
+    def peerlogout(self, link, nick):
+        user = self.users.get(nick)
+        if getattr(user, 'link', None) is not link:
+            return
+        for place in self.users, self.nicks, self.ops:
+            if place.get(nick) is user:
+                del place[nick]
+        self.myinfos.remove(user)
+        self.listmessages.clear()
+        user.loggedin = False
+
+    def peermyinfo(self, link, nick, myinfo):
+        user = self.users.get(nick)
+        if getattr(user, 'link', None) is link:
+            user.myinfo = myinfo
+            self.myinfos.add(user)
+
+    def peerremove(self, link, nick):
+        user = self.nicks.get(nick)
+        if user is not None and not hasattr(user, 'isremote'):
+            self.removeuser(user)
+
+    def peersend(self, link, nick, message):
+        user = self.nicks.get(nick)
+        if user is not None and not hasattr(user, 'isremote'):
+            user.sendmessage(message)
+
+if __name__ == '__main__':
+    run(ClusteredDCHub)
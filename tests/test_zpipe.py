@@ -0,0 +1,92 @@
+'''Tests for ZPipe0 compression of data sent to users'''
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+import zlib
+
+sys.path[:0] = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), path) for path in ('', 'src')]
+import DCHub
+
+class FakeFBConnectIface(object):
+    '''Facebook connection that treats every user as a friend'''
+    def isFriend(self, fbUid):
+        return True
+
+class ZPipeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ('conf', 'accounts', 'welcome', 'usercommands'):
+            open(os.path.join(self.directory, name), 'w').close()
+        os.mkdir(os.path.join(self.directory, 'bots'))
+        path = lambda name: os.path.join(self.directory, name)
+        self.hub = DCHub.DCHub(configfile=path('conf'), accountsfile=path('accounts'),
+            welcomefile=path('welcome'), usercommandsfile=path('usercommands'),
+            botsdir=path('bots'), chroot='0', changeuidgid='0', debug='1', port='0',
+            logfile='', pidfile='', loglevel='WARNING')
+        self.hub.polltimeout = 0.001
+        self.hub.validateFBToken = lambda token: (FakeFBConnectIface(), token)
+        self.hub.userlimits.update({'maxqueuedcommands':100, 'maxcommandspertimeperiod':100,
+            'maxmessagespertimeperiod':100, 'maxcharacterspertimeperiod':100000})
+        self.hub.commandsperround = 100
+        self.hub.setuplisteningsockets()
+        port = self.hub.listensocks.values()[0].getsockname()[1]
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setblocking(0)
+
+    def tearDown(self):
+        self.socket.close()
+        for listensock in self.hub.listensocks.values():
+            listensock.close()
+        shutil.rmtree(self.directory)
+
+    def exchange(self, message, ticks=4):
+        '''Send message to the hub, run the hub, and return what it sent back'''
+        if message:
+            self.socket.sendall(message)
+        data = ''
+        for i in range(ticks):
+            self.hub.processcommands()
+            self.hub.handleconnections()
+            time.sleep(0.01)
+            try:
+                while True:
+                    received = self.socket.recv(65536)
+                    if not received:
+                        break
+                    data += received
+            except socket.error:
+                pass
+        return data
+
+    def test_supports_zpipe_during_handshake(self):
+        self.exchange('')
+        self.assert_('$Lock ' in self.exchange('$FBAuthRand token|'))
+        self.assert_('$Supports ' in self.exchange('$Supports NoHello NoGetINFO ZPipe0|$Key abc|$ValidateNick zpipe|'))
+        self.exchange('$Version 1,0091|$GetNickList|$MyINFO $ALL zpipe desc<++ V:0.1>$ $DSL\x01$e@x$100$|')
+        self.assertEqual(self.hub.counters['rejectedprivileges'], 0)
+        self.assertEqual(self.hub.users['zpipe'].supports, ['NoHello', 'NoGetINFO', 'ZPipe0'])
+
+        messages = ['<zpipe> message %d %s|' % (i, 'x' * 200) for i in range(40)]
+        data = self.exchange(''.join(messages), ticks=20)
+        self.assert_('$ZOn|' in data, repr(data[:20]))
+        self.assertEqual(self.decompress(data), ''.join(messages))
+
+    def decompress(self, data):
+        '''Return data with every ZPipe block in it decompressed'''
+        parts = []
+        while '$ZOn|' in data:
+            start = data.index('$ZOn|')
+            parts.append(data[:start])
+            decompressor = zlib.decompressobj()
+            parts.append(decompressor.decompress(data[start+len('$ZOn|'):]))
+            data = decompressor.unused_data
+        parts.append(data)
+        return ''.join(parts)
+
+if __name__ == '__main__':
+    unittest.main()